@@ -0,0 +1,65 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def time_import(module, runs):
+    '''
+    Wall clock time of python -c "import module" in fresh interpreters, one value per run
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    times = []
+    for r in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import ' + module], cwd=REPO_DIR, env=env, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def slowest_imports(module, top):
+    '''
+    Packages with the largest cumulative import time according to python -X importtime
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=REPO_DIR, env=env,
+                         check=True, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    cumulative = {}
+    for l in out.splitlines():
+        if not l.startswith('import time:') or '|' not in l:
+            continue
+        elems = l[len('import time:'):].split('|')
+        if not elems[1].strip().isdigit():
+            continue
+        root = elems[2].strip().split('.')[0]
+        cumulative[root] = max(cumulative.get(root, 0.0), int(elems[1]) / 1e6)
+    return sorted(cumulative.items(), key=lambda x: -x[1])[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start import time of the CATS entry points')
+    parser.add_argument('-m', '--modules', nargs='+', default=['model.models', 'model.sent_models', 'eval.eval_model'])
+    parser.add_argument('-r', '--runs', type=int, default=5)
+    parser.add_argument('-mx', '--max_seconds', type=float, default=5.0, help='Fail if any median import time is above')
+    parser.add_argument('--verbose', action='store_true', help='Also print the slowest imported packages')
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.modules:
+        times = time_import(module, args.runs)
+        median = float(np.median(times))
+        print('%s: median %.3fs, min %.3fs, max %.3fs over %d runs' % (module, median, min(times), max(times), args.runs))
+        if args.verbose:
+            for name, t in slowest_imports(module, 10):
+                print('    %-30s %.3fs' % (name, t))
+        if median > args.max_seconds:
+            failed.append(module)
+    if len(failed) > 0:
+        print('Import time above %.1fs for: %s' % (args.max_seconds, ', '.join(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import time
+import numpy as np
+import torch
+from torch.profiler import profile, ProfilerActivity
+from model.layers import masked_softmax_pool
+
+def repeat_softmax_pool(S, valid, sents):
+    '''
+    The attention pooling the sentence models used before masked_softmax_pool
+    '''
+    b, seq = S.shape
+    S = torch.mul(valid, S)
+    beta = torch.exp(S) / torch.sum(torch.exp(S), 1).unsqueeze(1).repeat(1, seq)
+    return torch.sum(torch.mul(beta.reshape(b, 1, seq), sents), 2)
+
+def make_inputs(batch, seq, emb, device):
+    S = torch.randn(batch, seq, device=device)
+    lengths = torch.randint(1, seq + 1, (batch,), device=device)
+    valid = (torch.arange(seq, device=device).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    sents = torch.randn(batch, emb, seq, device=device) * valid.unsqueeze(1)
+    return S, valid, sents
+
+def latency(fn, args, runs, device):
+    '''
+    Median wall clock seconds of fn(*args) over runs calls after one warm up call
+    '''
+    times = []
+    with torch.no_grad():
+        fn(*args)
+        for r in range(runs):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            fn(*args)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def allocated_bytes(fn, args, device):
+    '''
+    Bytes allocated by the ops of one fn(*args) call, the peak allocation on cuda
+    '''
+    with torch.no_grad():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+            fn(*args)
+            torch.cuda.synchronize()
+            return torch.cuda.max_memory_allocated(device) - base
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn(*args)
+        return sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages())
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and memory of the attention pooling softmax')
+    parser.add_argument('-b', '--batches', type=int, nargs='+', default=[32, 256, 1024])
+    parser.add_argument('-s', '--max_seq', type=int, default=10)
+    parser.add_argument('-e', '--emb_size', type=int, default=768)
+    parser.add_argument('-r', '--runs', type=int, default=50)
+    parser.add_argument('--cuda', action='store_true', help='Run on cuda:0 instead of the cpu')
+    args = parser.parse_args()
+    device = torch.device('cuda:0' if args.cuda else 'cpu')
+
+    print('%6s  %-10s %12s %12s' % ('batch', 'pooling', 'latency ms', 'alloc MB'))
+    for batch in args.batches:
+        inputs = make_inputs(batch, args.max_seq, args.emb_size, device)
+        for name, fn in [('repeat', repeat_softmax_pool), ('masked', masked_softmax_pool)]:
+            print('%6d  %-10s %12.3f %12.2f' % (batch, name, latency(fn, inputs, args.runs, device) * 1000,
+                                              allocated_bytes(fn, inputs, device) / 2 ** 20))
+
+if __name__ == '__main__':
+    main()
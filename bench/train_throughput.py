@@ -0,0 +1,61 @@
+import argparse
+import os
+import time
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from model.models import CATSSimilarityModel, set_threads
+
+def train_steps(m, opt, batches, accum_steps):
+    '''
+    The training step of models.run_model over the given (X, y) batches
+    '''
+    mseloss = nn.MSELoss()
+    m.train()
+    opt.zero_grad()
+    for b, (X, y) in enumerate(batches):
+        loss = mseloss(m(X), y)
+        (loss / accum_steps).backward()
+        if (b + 1) % accum_steps == 0:
+            opt.step()
+            opt.zero_grad()
+
+def throughput(cats_type, batch, accum_steps, steps, emb_size):
+    '''
+    Training samples/sec of CATSSimilarityModel with cats_type, timed over steps batches after accum_steps warm up
+    batches
+    '''
+    m = CATSSimilarityModel(emb_size, cats_type)
+    opt = optim.Adam(m.parameters(), lr=0.00001)
+    batches = [(torch.randn(batch, 3 * emb_size), torch.randint(0, 2, (batch,)).float())
+               for _ in range(accum_steps)]
+    train_steps(m, opt, batches, accum_steps)
+    start = time.perf_counter()
+    for _ in range(steps // accum_steps):
+        train_steps(m, opt, batches, accum_steps)
+    return (steps // accum_steps) * accum_steps * batch / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU training throughput of CATSSimilarityModel')
+    parser.add_argument('-ct', '--cats_types', nargs='+', default=['cats', 'scaled', 'qscale', 'abl'])
+    parser.add_argument('-th', '--threads', type=int, nargs='+', default=[1, os.cpu_count()],
+                        help='Intra-op thread counts to compare')
+    parser.add_argument('-ith', '--interop_threads', type=int, default=0)
+    parser.add_argument('-bt', '--batch', type=int, default=32)
+    parser.add_argument('-ac', '--accum_steps', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('-n', '--steps', type=int, default=200, help='Timed batches per configuration')
+    parser.add_argument('-e', '--emb_size', type=int, default=768)
+    args = parser.parse_args()
+    set_threads(0, args.interop_threads)
+
+    print('%-8s %8s %6s %6s %14s' % ('type', 'threads', 'batch', 'accum', 'samples/sec'))
+    for threads in args.threads:
+        set_threads(threads)
+        for cats_type in args.cats_types:
+            for accum_steps in args.accum_steps:
+                print('%-8s %8d %6d %6d %14.1f' % (cats_type, threads, args.batch, accum_steps,
+                                                   throughput(cats_type, args.batch, accum_steps, args.steps,
+                                                              args.emb_size)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import torch
+import torch.nn as nn
+from sklearn.metrics import roc_auc_score
+from data.embedding_store import EmbeddingStore, VEC_DTYPES
+from data.qry_attn import QryAttn
+from data.utils import InputCATSDatasetBuilder
+from model.models import CATSSimilarityModel
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy and memory of the para vecs held in float16/bfloat16 '
+                                                 'against float32')
+    parser.add_argument('-qt', '--qry_attn_test', required=True)
+    parser.add_argument('-tp', '--test_pids', required=True)
+    parser.add_argument('-tv', '--test_pvecs', required=True)
+    parser.add_argument('-tq', '--test_qids', required=True)
+    parser.add_argument('-tqv', '--test_qvecs', required=True)
+    parser.add_argument('-mp', '--model_path', help='Trained CATSSimilarityModel, without it only the cosine '
+                                                    'baseline is compared')
+    parser.add_argument('-ct', '--cats_type', default='cats')
+    args = parser.parse_args()
+
+    qry_attn = QryAttn.load(args.qry_attn_test)
+    paras = EmbeddingStore(args.test_pids, args.test_pvecs)
+    queries = EmbeddingStore(args.test_qids, args.test_qvecs)
+    model = None
+    if args.model_path is not None:
+        model = CATSSimilarityModel(768, args.cats_type)
+        model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+        model.eval()
+    cos = nn.CosineSimilarity(dim=1, eps=1e-6)
+
+    print('%-9s %10s %12s %10s %10s %14s %14s' % ('dtype', 'vecs MB', 'max vec err', 'cos auc', 'model auc',
+                                                  'max score err', 'mean score err'))
+    ref_vecs, ref_scores = None, None
+    for dtype in VEC_DTYPES:
+        data = InputCATSDatasetBuilder(qry_attn, paras, queries, getattr(torch, dtype)).build_index_data()
+        X, y = data[:]
+        vecs = data.paravecs.float()
+        if ref_vecs is None:
+            ref_vecs = vecs
+        cos_auc = roc_auc_score(y.numpy(), cos(X[:, 768:768 * 2], X[:, 768 * 2:]).numpy())
+        model_auc, max_err, mean_err = float('nan'), float('nan'), float('nan')
+        if model is not None:
+            with torch.no_grad():
+                scores = model(X)
+            if ref_scores is None:
+                ref_scores = scores
+            model_auc = roc_auc_score(y.numpy(), scores.numpy())
+            max_err = torch.max(torch.abs(scores - ref_scores)).item()
+            mean_err = torch.mean(torch.abs(scores - ref_scores)).item()
+        print('%-9s %10.2f %12.2e %10.5f %10.5f %14.2e %14.2e' % (
+            dtype, data.paravecs.element_size() * data.paravecs.numel() / 2 ** 20,
+            torch.max(torch.abs(vecs - ref_vecs)).item(), cos_auc, model_auc, max_err, mean_err))
+
+if __name__ == '__main__':
+    main()
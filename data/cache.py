@@ -0,0 +1,72 @@
+import os
+import json
+from hashlib import sha1
+import numpy as np
+import torch
+
+def cache_key(files, *params):
+    '''
+    Hex digest identifying the content of files (path, size and mtime of each) together with the build params that
+    change what is cached, such as max_seq_len or the val split
+    '''
+    h = sha1()
+    for f in files:
+        st = os.stat(f)
+        h.update(('%s\t%d\t%d\n' % (os.path.abspath(f), st.st_size, st.st_mtime_ns)).encode())
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+class FeatureCache:
+    '''
+    On-disk cache of the pair datasets under cache_dir/<cache_key(files, *params)>, so changing any of the input files
+    or params starts a new entry instead of reusing stale data. Every array of an entry is one .npy shard, float
+    arrays are stored as float32 unless they are float16 or bfloat16 tensors, which keep their dtype (bfloat16 as
+    uint16 bits), and a json manifest of the dtypes written after the shards marks the entry complete. Shards are
+    loaded as copy-on-write memory maps and wrapped with torch.from_numpy, so nothing is read or copied until used.
+    '''
+    def __init__(self, cache_dir, files, *params):
+        self.path = os.path.join(cache_dir, cache_key(files, *params))
+
+    def _manifest(self, name):
+        return os.path.join(self.path, name + '.json')
+
+    def _shard(self, name, field):
+        return os.path.join(self.path, name + '.' + field + '.npy')
+
+    def __contains__(self, name):
+        return os.path.isfile(self._manifest(name))
+
+    def save(self, name, **arrays):
+        '''
+        Stores the named arrays (ndarray or tensor) as the entry name
+        '''
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        dtypes = {}
+        for field, a in arrays.items():
+            if torch.is_tensor(a) and a.dtype == torch.bfloat16:
+                a = a.view(torch.int16).numpy().view(np.uint16)
+                dtypes[field] = 'bfloat16'
+            else:
+                a = a.numpy() if torch.is_tensor(a) else np.asarray(a)
+                if np.issubdtype(a.dtype, np.floating) and a.dtype != np.float16:
+                    a = a.astype(np.float32, copy=False)
+                dtypes[field] = str(a.dtype)
+            np.save(self._shard(name, field), a)
+        with open(self._manifest(name), 'w') as f:
+            json.dump(dtypes, f)
+
+    def load(self, name):
+        '''
+        Returns the arrays of the entry name as a dict of tensors backed by the memory mapped shards
+        '''
+        with open(self._manifest(name), 'r') as f:
+            dtypes = json.load(f)
+        arrays = {}
+        for field, dtype in dtypes.items():
+            a = np.load(self._shard(name, field), mmap_mode='c')
+            if dtype == 'bfloat16':
+                arrays[field] = torch.from_numpy(a.view(np.int16)).view(torch.bfloat16)
+            else:
+                arrays[field] = torch.from_numpy(a)
+        return arrays
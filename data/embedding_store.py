@@ -0,0 +1,180 @@
+import os
+import json
+import argparse
+import numpy as np
+
+VEC_DTYPES = ('float32', 'float16', 'bfloat16')
+
+def to_float32(vecs):
+    '''
+    Upcasts vecs read from a vecs file to float32. uint16 vecs are taken as bfloat16 bit patterns, which is how
+    save_vecs stores bfloat16 as numpy has no such dtype.
+    '''
+    vecs = np.asarray(vecs)
+    if vecs.dtype == np.uint16:
+        return (vecs.astype(np.uint32) << 16).view(np.float32)
+    return vecs.astype(np.float32, copy=False)
+
+def from_float32(vecs, dtype):
+    '''
+    Rounds float vecs to the storage dtype, one of VEC_DTYPES, bfloat16 is returned as uint16 bit patterns
+    '''
+    vecs = np.asarray(vecs, dtype=np.float32)
+    if dtype == 'bfloat16':
+        bits = vecs.view(np.uint32)
+        # round to nearest even on the 16 dropped bits
+        return ((bits + 0x7fff + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+    return vecs.astype(dtype)
+
+def save_vecs(vecs_file, vecs, dtype='float32', chunk_rows=65536):
+    '''
+    Saves vecs (any array, such as another memory mapped vecs file) as the .npy vecs_file in the storage dtype,
+    chunk_rows rows at a time. float16 and bfloat16 take half the disk and page cache of float32 and are upcast by
+    to_float32 when read.
+    '''
+    out = np.lib.format.open_memmap(vecs_file, mode='w+', dtype=np.uint16 if dtype == 'bfloat16' else dtype,
+                                    shape=vecs.shape)
+    for i in range(0, vecs.shape[0], chunk_rows):
+        out[i:i + chunk_rows] = from_float32(to_float32(vecs[i:i + chunk_rows]), dtype)
+    out.flush()
+
+class EmbeddingStore:
+    '''
+    Read only ID -> vec lookup over a pair of .npy files such as *-all-pids.npy / *-all-paravecs.npy or
+    *-qids.npy / *-qvecs.npy. The vecs file is opened with mmap_mode='r' so only the rows that are looked up get paged
+    in, and processes opening the same files share one page cache. IDs are found by binary search in a sorted copy of
+    the ID column which is persisted beside the ids file (<ids file>.sorted.npy, <ids file>.order.npy) the first time a
+    store is opened, so later runs do not enumerate the IDs at all. The size, mtime and row count of the ids file are
+    recorded with it in <ids file>.index.json and the index is rebuilt when any of them changes.
+
+    For the sentence-wise files the ids file has rows (para ID, start, count), the ID column is the first one and
+    spans() returns the (start, count) of each para in the sentence vecs file.
+
+    The vecs file can be float32 or, to halve its size, float16 or bfloat16 as written by save_vecs. self.vecs keeps
+    the stored dtype and get() / gather() upcast the rows they return to float32.
+    '''
+    def __init__(self, ids_file, vecs_file):
+        self.ids_file = ids_file
+        self.vecs_file = vecs_file
+        self.ids = self._load_npy(ids_file)
+        self.vecs = self._load_npy(vecs_file)
+        self.sorted_ids, self.order = self._load_index()
+
+    @staticmethod
+    def from_arrays(ids, vecs):
+        '''
+        Builds an in-memory store from already loaded arrays, the sorted index is not persisted
+        '''
+        store = EmbeddingStore.__new__(EmbeddingStore)
+        store.ids_file = None
+        store.vecs_file = None
+        store.ids = np.asarray(ids)
+        store.vecs = np.asarray(vecs)
+        store.sorted_ids, store.order = store._build_index()
+        return store
+
+    @staticmethod
+    def _load_npy(path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except ValueError:
+            # object arrays can not be memory mapped
+            return np.load(path, allow_pickle=True).astype(str)
+
+    def _keys(self):
+        if self.ids.ndim == 1:
+            return np.asarray(self.ids)
+        return np.asarray(self.ids[:, 0])
+
+    def _build_index(self):
+        keys = self._keys()
+        order = np.argsort(keys, kind='stable')
+        return keys[order], order
+
+    def _ids_stat(self):
+        st = os.stat(self.ids_file)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'rows': int(self.ids.shape[0])}
+
+    def _load_index(self):
+        sorted_file = self.ids_file + '.sorted.npy'
+        order_file = self.ids_file + '.order.npy'
+        stat_file = self.ids_file + '.index.json'
+        ids_stat = self._ids_stat()
+        if os.path.isfile(sorted_file) and os.path.isfile(order_file) and os.path.isfile(stat_file):
+            with open(stat_file, 'r') as f:
+                index_stat = json.load(f)
+            if index_stat == ids_stat:
+                sorted_ids, order = np.load(sorted_file, mmap_mode='r'), np.load(order_file, mmap_mode='r')
+                if sorted_ids.shape[0] == order.shape[0] == ids_stat['rows']:
+                    return sorted_ids, order
+        sorted_ids, order = self._build_index()
+        try:
+            np.save(sorted_file, sorted_ids)
+            np.save(order_file, order)
+            # written last, an index without it or with a stale one is rebuilt
+            with open(stat_file, 'w') as f:
+                json.dump(ids_stat, f)
+        except OSError:
+            print('Could not persist the ID index of ' + self.ids_file + ', it will be rebuilt on the next run')
+        return sorted_ids, order
+
+    def __len__(self):
+        return self.order.shape[0]
+
+    def __contains__(self, id):
+        return bool(self.contains([id])[0])
+
+    def _search(self, ids):
+        keys = np.asarray(ids).reshape(-1)
+        if len(self) == 0:
+            return np.zeros(keys.shape[0], dtype=np.int64), np.zeros(keys.shape[0], dtype=bool)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, keys), len(self) - 1)
+        rows = np.asarray(self.order[pos])
+        # checked against the ids file itself, so an index that does not belong to it can never return wrong rows
+        found = np.asarray(self.sorted_ids[pos] == keys) & np.asarray(self._keys()[rows] == keys)
+        return rows, found
+
+    def contains(self, ids):
+        '''
+        Returns a bool array telling which of the ids are present in the store
+        '''
+        return self._search(ids)[1]
+
+    def rows(self, ids):
+        '''
+        Returns the row numbers of the ids in the ids and vecs files, raises KeyError for unknown ids
+        '''
+        rows, found = self._search(ids)
+        if not found.all():
+            raise KeyError(str(np.asarray(ids).reshape(-1)[~found][:10].tolist()) + ' not present in ' +
+                           str(self.ids_file))
+        return rows
+
+    def gather(self, rows):
+        '''
+        Returns the vecs at the row numbers rows as a float32 ndarray of shape (len(rows) X vec size)
+        '''
+        return to_float32(self.vecs[rows])
+
+    def get(self, ids):
+        '''
+        Returns the vecs of the ids as a float32 ndarray of shape (len(ids) X vec size)
+        '''
+        return self.gather(self.rows(ids))
+
+    def spans(self, ids):
+        '''
+        Sentence-wise stores only: returns an int array of shape (len(ids) X 2) of (start, count) of each para
+        '''
+        return np.asarray(self.ids[self.rows(ids), 1:]).astype(np.int64)
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a vecs file to another storage dtype')
+    parser.add_argument('-i', '--input_vecs', help='Path to the .npy vecs file')
+    parser.add_argument('-o', '--output_vecs', help='Path to the converted .npy vecs file, use it with the same ids file')
+    parser.add_argument('-dt', '--dtype', choices=VEC_DTYPES, default='float16')
+    args = parser.parse_args()
+    save_vecs(args.output_vecs, np.load(args.input_vecs, mmap_mode='r'), args.dtype)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import os
+import json
+import argparse
+import numpy as np
+from data.query_embedding import encode
+
+def read_paratext(paratext_file):
+    '''
+    Yields (para ID, text) of each line of a paratext tsv, paras without text get ''
+    '''
+    with open(paratext_file, 'r') as f:
+        for l in f:
+            elems = l.rstrip('\n').split('\t')
+            yield elems[0], elems[1].strip() if len(elems) > 1 else ''
+
+def split_sentences(text):
+    from nltk.tokenize import sent_tokenize
+    return [s for s in sent_tokenize(text) if s.strip()]
+
+class EmbeddingShards:
+    '''
+    Append-only para embeddings of one model in out_dir. Every append() writes one shard, <kind>-NNNNN.ids.npy and
+    <kind>-NNNNN.vecs.npy (float32), and then records its para and vec row counts in <kind>-index.json, so a run that
+    stops half way leaves the shards of the previous appends intact. kind is 'para' for one vec per para, with ids
+    the para IDs, or 'sent' for the sentence-wise vecs, with ids rows (para ID, start, count) and start relative to
+    the shard. export() concatenates the shards into the pids/paravecs or sentwise file pair read by EmbeddingStore.
+    '''
+    def __init__(self, out_dir, embedding_model, sentwise=False):
+        self.out_dir = out_dir
+        self.kind = 'sent' if sentwise else 'para'
+        self.index_file = os.path.join(out_dir, self.kind + '-index.json')
+        self.index = {'model': embedding_model, 'shards': []}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+            if self.index['model'] != embedding_model:
+                raise ValueError(out_dir + ' holds embeddings of ' + self.index['model'] + ', not of ' +
+                                 embedding_model)
+
+    def _file(self, shard, part):
+        return os.path.join(self.out_dir, shard + '.' + part + '.npy')
+
+    def _ids(self, shard):
+        return np.load(self._file(shard['name'], 'ids'))
+
+    def para_ids(self):
+        '''
+        Set of the IDs of all the embedded paras
+        '''
+        ids = set()
+        for shard in self.index['shards']:
+            shard_ids = self._ids(shard)
+            ids.update((shard_ids[:, 0] if shard_ids.ndim == 2 else shard_ids).tolist())
+        return ids
+
+    def append(self, ids, vecs):
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        name = '%s-%05d' % (self.kind, len(self.index['shards']))
+        np.save(self._file(name, 'vecs'), np.asarray(vecs, dtype=np.float32))
+        np.save(self._file(name, 'ids'), np.asarray(ids, dtype=str))
+        self.index['shards'].append({'name': name, 'paras': len(ids), 'rows': int(vecs.shape[0])})
+        with open(self.index_file + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def export(self, ids_file, vecs_file, para_ids=None):
+        '''
+        Writes the paras in para_ids (all paras if None) as the ids / vecs .npy pair read by EmbeddingStore, for the
+        sentence-wise shards with the starts rebased onto the exported vecs file. The vecs are copied shard by shard.
+        Raises ValueError if nothing has been embedded yet, as the vec size is then unknown.
+        '''
+        if len(self.index['shards']) == 0:
+            raise ValueError('No paras embedded in ' + self.out_dir + ', nothing to export')
+        selected = []
+        rows = 0
+        for shard in self.index['shards']:
+            ids = self._ids(shard)
+            keep = np.ones(ids.shape[0], dtype=bool) if para_ids is None else \
+                np.isin(ids[:, 0] if ids.ndim == 2 else ids, list(para_ids))
+            if self.kind == 'sent':
+                spans = ids[keep, 1:].astype(np.int64)
+                vec_rows = np.repeat(spans[:, 0], spans[:, 1]) + \
+                    np.arange(spans[:, 1].sum()) - np.repeat(np.cumsum(spans[:, 1]) - spans[:, 1], spans[:, 1])
+            else:
+                vec_rows = np.nonzero(keep)[0]
+            selected.append((shard, ids[keep], vec_rows))
+            rows += vec_rows.shape[0]
+        emb_len = np.load(self._file(self.index['shards'][0]['name'], 'vecs'), mmap_mode='r').shape[1]
+        out_vecs = np.lib.format.open_memmap(vecs_file, mode='w+', dtype=np.float32, shape=(rows, emb_len))
+        out_ids = []
+        start = 0
+        for shard, ids, vec_rows in selected:
+            vecs = np.load(self._file(shard['name'], 'vecs'), mmap_mode='r')
+            out_vecs[start:start + vec_rows.shape[0]] = vecs[vec_rows]
+            if self.kind == 'sent':
+                counts = ids[:, 2].astype(np.int64)
+                starts = start + np.cumsum(counts) - counts
+                ids = np.stack((ids[:, 0], starts.astype(str), counts.astype(str)), 1)
+            out_ids.append(ids)
+            start += vec_rows.shape[0]
+        out_vecs.flush()
+        np.save(ids_file, np.concatenate(out_ids))
+
+def embed_paras(paratext_file, out_dir, embedding_model, sentwise=False, batch_size=32, shard_paras=10000,
+                processes=0):
+    '''
+    Embeds the paras of paratext_file that are not yet in the EmbeddingShards of out_dir, shard_paras paras per
+    shard, with one vec per para or, with sentwise, one vec per sentence. Returns the shards.
+    '''
+    shards = EmbeddingShards(out_dir, embedding_model, sentwise)
+    done = shards.para_ids()
+    todo = []
+
+    def flush():
+        pids = [p for p, _ in todo]
+        if sentwise:
+            sents = [split_sentences(t) for _, t in todo]
+            counts = np.array([len(s) for s in sents], dtype=np.int64)
+            vecs = encode([s for para in sents for s in para], embedding_model, batch_size, processes)
+            starts = np.cumsum(counts) - counts
+            shards.append(np.stack((pids, starts.astype(str), counts.astype(str)), 1), vecs)
+        else:
+            shards.append(np.array(pids), encode([t for _, t in todo], embedding_model, batch_size, processes))
+        print('Embedded ' + str(len(done)) + ' paras')
+        del todo[:]
+
+    for pid, text in read_paratext(paratext_file):
+        if pid in done:
+            continue
+        done.add(pid)
+        todo.append((pid, text))
+        if len(todo) == shard_paras:
+            flush()
+    if len(todo) > 0:
+        flush()
+    return shards
+
+def main():
+    parser = argparse.ArgumentParser(description='Embed the paras of a paratext tsv into pids/paravecs or sentwise '
+                                                 'files, reusing the paras embedded by earlier runs')
+    parser.add_argument('-pt', '--paratext', help='Path to paratext tsv')
+    parser.add_argument('-od', '--out_dir', default='para_vec_shards', help='Directory of the embedding shards')
+    parser.add_argument('-m', '--model', default='bert-base-nli-mean-tokens')
+    parser.add_argument('--sentwise', action='store_true', help='One vec per sentence instead of one per para')
+    parser.add_argument('-bs', '--batch_size', type=int, default=32)
+    parser.add_argument('-sp', '--shard_paras', type=int, default=10000, help='Paras per shard')
+    parser.add_argument('-np', '--processes', type=int, default=0, help='Encoding processes, 0 to encode in process')
+    parser.add_argument('-op', '--out_pids', help='Output pids .npy of the paras of the paratext file')
+    parser.add_argument('-ov', '--out_pvecs', help='Output paravecs .npy of the paras of the paratext file')
+    args = parser.parse_args()
+    shards = embed_paras(args.paratext, args.out_dir, args.model, args.sentwise, args.batch_size, args.shard_paras,
+                         args.processes)
+    if args.out_pids is not None:
+        shards.export(args.out_pids, args.out_pvecs, set(p for p, _ in read_paratext(args.paratext)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import numpy as np
+
+class Qrels:
+    '''
+    A TREC qrels file (query 0 para rel per line) parsed one line at a time, with the IDs interned to int codes. The
+    queries are the pages of an article qrels or the sections of a toplevel / hierarchical qrels, in the order of
+    their first appearance.
+
+    query_paras[offsets[g]:offsets[g+1]] are the int32 para codes of the g-th query in file order and para_query is
+    the int32 code of the query each para is listed under (the last one if there are several, -1 for paras not in
+    this file). Para codes index the object array self.para_ids. Passing the para_index of another Qrels shares its
+    para codes, so the sections of a page's paras can be looked up without going through the para IDs.
+    '''
+    def __init__(self, qrels_file, para_index=None):
+        self.query_index = {}
+        self.para_index = {} if para_index is None else para_index
+        query_codes = []
+        para_codes = []
+        with open(qrels_file, 'r') as f:
+            for l in f:
+                elems = l.split(' ', 3)
+                if len(elems) < 3:
+                    continue
+                query_codes.append(self.query_index.setdefault(elems[0], len(self.query_index)))
+                para_codes.append(self.para_index.setdefault(elems[2], len(self.para_index)))
+        self.queries = list(self.query_index)
+        # the codes of this file are all below len(para_index) at this point, later files sharing it only append
+        self.para_ids = np.array(list(self.para_index), dtype=object)
+        query_codes = np.array(query_codes, dtype=np.int32)
+        para_codes = np.array(para_codes, dtype=np.int32)
+        order = np.argsort(query_codes, kind='stable')
+        self.query_paras = para_codes[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(query_codes, minlength=len(self.queries))))) \
+            .astype(np.int64)
+        self.para_query = np.full(len(self.para_index), -1, dtype=np.int32)
+        self.para_query[para_codes] = query_codes
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def __contains__(self, query):
+        return query in self.query_index
+
+    def para_codes(self, query):
+        g = self.query_index[query]
+        return self.query_paras[self.offsets[g]:self.offsets[g + 1]]
+
+    def paras(self, query):
+        '''
+        Para IDs of query in file order
+        '''
+        return self.para_ids[self.para_codes(query)].tolist()
+
+    def codes(self, paras):
+        return np.array([self.para_index[p] for p in paras], dtype=np.int32)
+
+    def labels(self, para_codes):
+        '''
+        Query codes of the para codes, -1 for paras not in this file
+        '''
+        para_codes = np.asarray(para_codes, dtype=np.int64)
+        labels = np.full(para_codes.shape[0], -1, dtype=np.int32)
+        known = para_codes < self.para_query.shape[0]
+        labels[known] = self.para_query[para_codes[known]]
+        return labels
+
+def num_sections(page_qrels, section_qrels):
+    '''
+    int array of the number of distinct sections of section_qrels that the paras of each page of page_qrels are
+    listed under, in the order of page_qrels.queries. Both must share their para codes. Raises KeyError for paras of
+    page_qrels that section_qrels does not list, as they have no section to count.
+    '''
+    page_of_para = np.repeat(np.arange(len(page_qrels)), np.diff(page_qrels.offsets))
+    sections = section_qrels.labels(page_qrels.query_paras).astype(np.int64)
+    if (sections < 0).any():
+        missing = page_qrels.para_ids[page_qrels.query_paras[sections < 0]]
+        raise KeyError(str(missing[:10].tolist()) + ' have no section in the section qrels')
+    pairs = np.unique(page_of_para * (len(section_qrels) + 1) + sections + 1)
+    return np.bincount(pairs // (len(section_qrels) + 1), minlength=len(page_qrels))
+
+def read_cluster_qrels(article_qrels, top_qrels, hier_qrels):
+    '''
+    Article, toplevel and hierarchical Qrels sharing their para codes, with the number of toplevel and hierarchical
+    sections of each page
+    '''
+    pages = Qrels(article_qrels)
+    top = Qrels(top_qrels, pages.para_index)
+    hier = Qrels(hier_qrels, pages.para_index)
+    return pages, top, hier, num_sections(pages, top), num_sections(pages, hier)
@@ -0,0 +1,64 @@
+import numpy as np
+
+class QryAttn:
+    '''
+    qry_attn data: [[query ID, para1 ID, para2 ID, label], ....] grouped by query. The rows of each query are kept
+    contiguous, with the queries in the order of their first appearance, and offsets[g]:offsets[g+1] is the slice of
+    the g-th query. A file that already lists each query in one block keeps its order, so training and the
+    train/val split see the same rows as before.
+
+    It iterates, indexes and has a length like the plain list of rows it replaces, so it can be handed to the
+    dataset builders as is, and page(qid) returns the rows of one query without scanning the rest.
+    '''
+    def __init__(self, rows):
+        rows = list(rows)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.qids = []
+        self.qid_index = {}
+        self.rows = rows
+        if len(rows) == 0:
+            return
+        uniq, first, inv = np.unique(np.array([r[0] for r in rows]), return_index=True, return_inverse=True)
+        appearance = np.argsort(first, kind='stable')
+        group = np.empty(len(uniq), dtype=np.int64)
+        group[appearance] = np.arange(len(uniq))
+        row_group = group[inv.reshape(-1)]
+        order = np.argsort(row_group, kind='stable')
+        self.rows = [rows[i] for i in order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(row_group, minlength=len(uniq))))).astype(np.int64)
+        self.qids = [str(q) for q in uniq[appearance]]
+        self.qid_index = {q: g for g, q in enumerate(self.qids)}
+
+    @staticmethod
+    def load(qry_attn_file, header=True):
+        '''
+        Reads a tab separated qry_attn file, the first line is skipped as header unless header=False
+        '''
+        rows = []
+        with open(qry_attn_file, 'r') as f:
+            if header:
+                next(f, None)
+            for l in f:
+                rows.append(l.split('\t'))
+        return QryAttn(rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __contains__(self, qid):
+        return qid in self.qid_index
+
+    def page(self, qid):
+        '''
+        Rows of the query qid, an empty list if the query is not present
+        '''
+        if qid not in self.qid_index:
+            return []
+        g = self.qid_index[qid]
+        return self.rows[self.offsets[g]:self.offsets[g + 1]]
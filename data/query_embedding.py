@@ -0,0 +1,121 @@
+import os
+import argparse
+from hashlib import sha1
+import numpy as np
+from data.embedding_store import EmbeddingStore
+
+_models = {}
+
+def get_model(embedding_model):
+    '''
+    Process wide SentenceTransformer of each embedding model name, loaded on first use
+    '''
+    if embedding_model not in _models:
+        from sentence_transformers import SentenceTransformer
+        _models[embedding_model] = SentenceTransformer(embedding_model)
+    return _models[embedding_model]
+
+def query_id(query):
+    return 'Query:' + sha1(str.encode(query)).hexdigest()
+
+def encode(texts, embedding_model, batch_size=32, processes=0):
+    '''
+    float32 vecs of shape (len(texts) X v) of the texts, encoded by processes worker processes if > 1
+    '''
+    model = get_model(embedding_model)
+    if len(texts) == 0:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    if processes > 1:
+        pool = model.start_multi_process_pool(target_devices=['cpu'] * processes)
+        try:
+            vecs = model.encode_multi_process(texts, pool, batch_size=batch_size)
+        finally:
+            model.stop_multi_process_pool(pool)
+    else:
+        vecs = model.encode(texts, batch_size=batch_size, show_progress_bar=True)
+    return np.asarray(vecs, dtype=np.float32).reshape(len(texts), -1)
+
+class QueryEmbeddingCache:
+    '''
+    Persistent query ID -> vec cache of one embedding model, kept as the qids.npy / qvecs.npy pair of an
+    EmbeddingStore under cache_dir/<model name>. embed() encodes only the queries no earlier run has embedded with
+    the same model and adds them to the cache.
+    '''
+    def __init__(self, cache_dir, embedding_model):
+        self.embedding_model = embedding_model
+        self.path = os.path.join(cache_dir, embedding_model.replace('/', '__'))
+        self.qids_file = os.path.join(self.path, 'qids.npy')
+        self.qvecs_file = os.path.join(self.path, 'qvecs.npy')
+        self.store = self._open()
+
+    def _open(self):
+        if os.path.isfile(self.qids_file) and os.path.isfile(self.qvecs_file):
+            return EmbeddingStore(self.qids_file, self.qvecs_file)
+        return EmbeddingStore.from_arrays(np.zeros(0, dtype=str), np.zeros((0, 0), dtype=np.float32))
+
+    def _add(self, qids, qvecs):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if len(self.store) > 0:
+            qids = np.concatenate((np.asarray(self.store.ids), qids))
+            qvecs = np.concatenate((np.asarray(self.store.vecs), qvecs))
+        # written beside and renamed, so an interrupted run leaves the previous cache intact
+        np.save(self.qvecs_file + '.tmp.npy', qvecs)
+        np.save(self.qids_file + '.tmp.npy', qids)
+        os.replace(self.qvecs_file + '.tmp.npy', self.qvecs_file)
+        os.replace(self.qids_file + '.tmp.npy', self.qids_file)
+        self.store = self._open()
+
+    def embed(self, query_list, batch_size=32, processes=0):
+        '''
+        Returns the query IDs of the distinct queries of query_list in order of first appearance and their vecs as a
+        float32 ndarray
+        '''
+        queries = list(dict.fromkeys(query_list))
+        qids = np.array([query_id(q) for q in queries], dtype=str)
+        missing = ~self.store.contains(qids) if len(qids) > 0 else np.zeros(0, dtype=bool)
+        if missing.any():
+            print('Encoding ' + str(int(missing.sum())) + ' of ' + str(len(queries)) + ' queries')
+            self._add(qids[missing], encode([q for i, q in enumerate(queries) if missing[i]], self.embedding_model,
+                                            batch_size, processes))
+        return qids, self.store.get(qids)
+
+def embed_queries(query_list, embedding_model, cache_dir=None, batch_size=32, processes=0):
+    '''
+    Query IDs and float32 vecs of the distinct queries of query_list, read from and added to the
+    QueryEmbeddingCache of cache_dir if given
+    '''
+    if cache_dir is not None:
+        return QueryEmbeddingCache(cache_dir, embedding_model).embed(query_list, batch_size, processes)
+    queries = list(dict.fromkeys(query_list))
+    return np.array([query_id(q) for q in queries], dtype=str), encode(queries, embedding_model, batch_size,
+                                                                       processes)
+
+def save_query_vecs(qids_file, qvecs_file, qids, qvecs):
+    '''
+    Writes the qids / qvecs .npy pair read by EmbeddingStore
+    '''
+    np.save(qids_file, np.asarray(qids, dtype=str))
+    np.save(qvecs_file, np.asarray(qvecs, dtype=np.float32))
+
+def main():
+    parser = argparse.ArgumentParser(description='Embed queries into a qids/qvecs .npy pair')
+    parser.add_argument('-qf', '--query_file', help='Text file with one query per line, or a tsv with -col')
+    parser.add_argument('-col', '--column', type=int, default=None, help='Column of the queries in a tsv query file')
+    parser.add_argument('-m', '--model', default='bert-base-nli-mean-tokens')
+    parser.add_argument('-cd', '--cache_dir', default='query_vec_cache', help='Persistent cache of embedded queries')
+    parser.add_argument('-bs', '--batch_size', type=int, default=32)
+    parser.add_argument('-np', '--processes', type=int, default=0, help='Encoding processes, 0 to encode in process')
+    parser.add_argument('-oq', '--out_qids', help='Output qids .npy')
+    parser.add_argument('-ov', '--out_qvecs', help='Output qvecs .npy')
+    args = parser.parse_args()
+    with open(args.query_file, 'r') as f:
+        if args.column is None:
+            queries = [l.rstrip('\n') for l in f]
+        else:
+            queries = [l.rstrip('\n').split('\t')[args.column] for l in f]
+    qids, qvecs = embed_queries(queries, args.model, args.cache_dir, args.batch_size, args.processes)
+    save_query_vecs(args.out_qids, args.out_qvecs, qids, qvecs)
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,151 @@
 import numpy as np
 from itertools import combinations
 from hashlib import sha1
-from sentence_transformers import SentenceTransformer
+from data.embedding_store import EmbeddingStore, to_float32
+from data.qry_attn import QryAttn
+from data.qrels import Qrels
+from data.query_embedding import embed_queries
 import torch
 torch.manual_seed(42)
+from torch.utils.data import Dataset, IterableDataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler, \
+    get_worker_info
+
+def storage_tensor(vecs, dtype=None):
+    '''
+    Vecs as a tensor held in dtype, torch.float16 or torch.bfloat16 to halve the memory of large vec matrices, the
+    pair datasets upcast the rows of each batch to float32. By default float16 and bfloat16 vecs keep their dtype and
+    anything else is converted to float32.
+    '''
+    vecs = torch.as_tensor(vecs)
+    if dtype is None:
+        dtype = vecs.dtype if vecs.dtype in (torch.float16, torch.bfloat16) else torch.float
+    return vecs.to(dtype)
+
+class CATSPairDataset(Dataset):
+    '''
+    Para pairs stored as int index arrays (qidx, pidx1, pidx2) with float labels, pointing into the shared query and
+    para vec matrices. Indexing with an int, slice or index array gathers the rows on the fly with index_select and
+    returns X of shape (b X 3*v), laid out as [query vec, para1 vec, para2 vec] like build_input_data, and y of shape (b)
+    The para vecs may be held in float16 or bfloat16 (see storage_tensor), X is always float32.
+    '''
+    def __init__(self, qidx, pidx1, pidx2, labels, qvecs, paravecs):
+        self.qidx = torch.as_tensor(qidx, dtype=torch.long)
+        self.pidx1 = torch.as_tensor(pidx1, dtype=torch.long)
+        self.pidx2 = torch.as_tensor(pidx2, dtype=torch.long)
+        self.labels = torch.as_tensor(labels, dtype=torch.float)
+        self.qvecs = torch.as_tensor(qvecs, dtype=torch.float)
+        self.paravecs = storage_tensor(paravecs)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __getitem__(self, idx):
+        single = isinstance(idx, int)
+        if isinstance(idx, slice):
+            idx = torch.arange(len(self))[idx]
+        idx = torch.as_tensor(idx, dtype=torch.long).reshape(-1)
+        X = torch.cat((self.qvecs.index_select(0, self.qidx[idx]),
+                       self.paravecs.index_select(0, self.pidx1[idx]).float(),
+                       self.paravecs.index_select(0, self.pidx2[idx]).float()), 1)
+        y = self.labels[idx]
+        if single:
+            return X[0], y[0]
+        return X, y
+
+    def subset(self, idx):
+        '''
+        Returns a dataset of the selected pairs sharing the same vec matrices
+        '''
+        return CATSPairDataset(self.qidx[idx], self.pidx1[idx], self.pidx2[idx], self.labels[idx], self.qvecs,
+                               self.paravecs)
+
+    def save(self, cache, name):
+        '''
+        Stores the dataset as the entry name of the FeatureCache cache
+        '''
+        cache.save(name, qidx=self.qidx, pidx1=self.pidx1, pidx2=self.pidx2, labels=self.labels, qvecs=self.qvecs,
+                   paravecs=self.paravecs)
+
+    @staticmethod
+    def load(cache, name):
+        return CATSPairDataset(**cache.load(name))
 
 class InputClusterDatasetBuilder:
     '''
     query_para_data: {query ID:{'paras':[], 'cluster_labels':[]}, .... }
+    para_store, query_store: EmbeddingStore of the para vecs and the query vecs
     Each query should have equal num of paras and cluster labels, otherwise it will fail assetion
     Output from build_input_data -> X: 3D tensor of shape n X mC2 X 3*v where n = num of samples,
     m = num of paras for each query, v = emb vec length
     y: 2D tensor of shape n X mC2 containing similarity labels
+    Para pairs of each query follow the order of combinations(range(m), 2)
     '''
-    def __init__(self, query_para_data, paraids_npy, paravecs_npy, query_emb_vecs):
+    def __init__(self, query_para_data, para_store, query_store):
         paranums = [len(query_para_data[q]['paras']) for q in query_para_data.keys()]
         labelnums = [len(query_para_data[q]['cluster_labels']) for q in query_para_data.keys()]
         assert len(set(paranums)) == 1
         assert len(set(labelnums)) == 1
-        paralist = []
-        for q, data in query_para_data.items():
-            paralist += data['paras']
-        paraids = list(paraids_npy)
-        assert set(paralist).issubset(set(paraids)) is True
-        self.paralist = list(set(paralist))
-        self.para_vecs = {}
-        for p in self.paralist:
-            self.para_vecs[p] = paravecs_npy[paraids.index(p)]
         self.query_para_data = query_para_data
-        self.query_vecs = query_emb_vecs
+        self.queries = list(query_para_data.keys())
         self.m = paranums[0]
+        para_rows = para_store.rows([p for q in self.queries for p in query_para_data[q]['paras']])
+        # vecs of the distinct paras, each query refers to them by local row
+        rows, local_rows = np.unique(para_rows, return_inverse=True)
+        self.para_vecs = para_store.gather(rows)
+        self.para_index = local_rows.reshape(len(self.queries), self.m)
+        self.query_vecs = np.asarray(query_store.get(self.queries), dtype=np.float32)
+        self.cluster_labels = np.array([query_para_data[q]['cluster_labels'] for q in self.queries])
+        self.pair_index = np.array(list(combinations(range(self.m), 2)), dtype=np.int64).reshape(-1, 2)
+
+    def build_page_data(self):
+        '''
+        Compact form of build_input_data for models that score whole pages: Xq of shape (n X v), Xp of shape
+        (n X m X v) and y of shape (n X mC2)
+        '''
+        Xp = np.take(self.para_vecs, self.para_index, axis=0)
+        y = np.take(self.cluster_labels, self.pair_index[:, 0], axis=1) == \
+            np.take(self.cluster_labels, self.pair_index[:, 1], axis=1)
+        return torch.from_numpy(self.query_vecs), torch.from_numpy(Xp), torch.from_numpy(y.astype(np.float32))
 
     def build_input_data(self):
-        para_pair_indices = [p for p in combinations(range(self.m), 2)]
-        X = []
-        y = []
-        for q, data in self.query_para_data.items():
-            paras = data['paras']
-            cluster_labels = data['cluster_labels']
-            qvec = list(self.query_vecs[q]['query_vec'])
-            X_row = []
-            y_row = []
-            for pair_index in para_pair_indices:
-                X_row.append(qvec + list(self.para_vecs[paras[pair_index[0]]]) +
-                             list(self.para_vecs[paras[pair_index[1]]]))
-                y_row.append(1 if cluster_labels[pair_index[0]] == cluster_labels[pair_index[1]] else 0)
-            X.append(X_row)
-            y.append(y_row)
-        X = np.array(X)
-        y = np.array(y)
+        n = len(self.queries)
+        npairs = self.pair_index.shape[0]
+        Xp = np.take(self.para_vecs, self.para_index, axis=0)
+        X = np.concatenate((np.broadcast_to(self.query_vecs[:, None, :], (n, npairs, self.query_vecs.shape[1])),
+                            np.take(Xp, self.pair_index[:, 0], axis=1),
+                            np.take(Xp, self.pair_index[:, 1], axis=1)), axis=2)
+        y = (np.take(self.cluster_labels, self.pair_index[:, 0], axis=1) ==
+             np.take(self.cluster_labels, self.pair_index[:, 1], axis=1)).astype(int)
         print('X shape: '+str(X.shape)+', y shape: '+str(y.shape))
         return X, y
 
 class InputCATSDatasetBuilder:
     '''
     query_attn_data: [[query ID, para1 ID, para2 ID, int label], ....]
+    para_store, query_store: EmbeddingStore of the para vecs and the query vecs
+    vec_dtype: dtype the para vecs of build_index_data are held in, see storage_tensor
+    All inputs are built in float32.
     '''
-    def __init__(self, query_attn_data, paraids_npy, paravecs_npy, queryids_npy, queryvecs_npy):
+    def __init__(self, query_attn_data, para_store, query_store, vec_dtype=None):
         paralist = []
         querylist = []
         for data in query_attn_data:
             querylist.append(data[0])
             paralist.append(data[1])
             paralist.append(data[2])
-        self.paraids = list(paraids_npy)
-        self.paravecs_npy = paravecs_npy
-        assert set(paralist).issubset(set(self.paraids)) is True
-        queries = list(queryids_npy)
-        self.query_attn_data = query_attn_data
+        self.para_store = para_store
+        self.query_store = query_store
+        self.vec_dtype = vec_dtype
         paralist = list(set(paralist))
         querylist = list(set(querylist))
-        self.para_vecs = {}
-        paraids_dict = {}
-        for i, para in enumerate(self.paraids):
-            paraids_dict[para] = i
-        queries_dict = {}
-        for i, q in enumerate(queries):
-            queries_dict[q] = i
+        assert para_store.contains(paralist).all()
+        self.query_attn_data = query_attn_data
         #print('Going to initialize para vecs')
-        for p in paralist:
-            self.para_vecs[p] = paravecs_npy[paraids_dict[p]]
-        self.query_vecs = {}
-        missing_queries = set()
-        for q in querylist:
-            if q not in queries_dict.keys():
-                missing_queries.add(q)
-            else:
-                self.query_vecs[q] = queryvecs_npy[queries_dict[q]]
+        self.para_vecs = dict(zip(paralist, para_store.get(paralist)))
+        present = query_store.contains(querylist)
+        missing_queries = set([q for i, q in enumerate(querylist) if not present[i]])
+        querylist = [q for i, q in enumerate(querylist) if present[i]]
+        self.query_vecs = dict(zip(querylist, query_store.get(querylist)))
         if len(missing_queries) > 0:
             print('Following '+str(len(missing_queries))+' queries are present in qry_attn file but not in context json file')
             print('The root cause is these queries are present in article.qrels without any / but in top-level, hier level'
@@ -96,208 +155,434 @@ class InputCATSDatasetBuilder:
         #print('Init done')
 
     def build_input_data(self, qry_attn_data=None):
-        X = []
-        y = []
+        X, y = self.build_index_data(qry_attn_data)[:]
+        #print('X shape: ' + str(X.shape) + ', y shape: ' + str(y.shape))
+        return X, y
+
+    def build_index_data(self, qry_attn_data=None):
+        '''
+        Same pairs as build_input_data but returned as a CATSPairDataset, which keeps only the vecs of the queries and
+        paras present in qry_attn_data and gathers the 3*v rows batch by batch
+        '''
         if qry_attn_data == None:
             qry_attn_data = self.query_attn_data
+        query_index = {}
+        para_index = {}
+        qidx = []
+        pidx1 = []
+        pidx2 = []
+        y = []
         for qid, pid1, pid2, label in qry_attn_data:
             if qid in self.query_vecs.keys():
-                row = np.hstack((self.query_vecs[qid], self.para_vecs[pid1], self.para_vecs[pid2]))
+                qidx.append(query_index.setdefault(qid, len(query_index)))
+                pidx1.append(para_index.setdefault(pid1, len(para_index)))
+                pidx2.append(para_index.setdefault(pid2, len(para_index)))
                 y.append(float(label))
-                X.append(row)
-        X = torch.tensor(X)
-        y = torch.tensor(y)
-        #print('X shape: ' + str(X.shape) + ', y shape: ' + str(y.shape))
-        return X, y
+        qvecs = np.array([self.query_vecs[q] for q in query_index.keys()], dtype=np.float32).reshape(len(query_index), -1)
+        paravecs = np.array([self.para_vecs[p] for p in para_index.keys()], dtype=np.float32).reshape(len(para_index), -1)
+        return CATSPairDataset(np.array(qidx), np.array(pidx1), np.array(pidx2), np.array(y), qvecs,
+                               storage_tensor(paravecs, self.vec_dtype))
 
     def build_input_data_with_pairs(self, qry_attn_data=None):
-        X = []
-        y = []
-        pairs = []
         if qry_attn_data == None:
             qry_attn_data = self.query_attn_data
+        X, y = self.build_input_data(qry_attn_data)
+        pairs = []
         for qid, pid1, pid2, label in qry_attn_data:
             if qid in self.query_vecs.keys():
-                row = np.hstack((self.query_vecs[qid], self.para_vecs[pid1], self.para_vecs[pid2]))
-                y.append(float(label))
-                X.append(row)
                 if pid1 < pid2:
                     pairs.append(pid1 + '_' + pid2)
                 else:
                     pairs.append(pid2 + '_' + pid1)
-        X = torch.tensor(X)
-        y = torch.tensor(y)
-        #print('X shape: ' + str(X.shape) + ', y shape: ' + str(y.shape))
         return X, y, pairs
 
-    def build_cluster_data(self, qid, paralist):
-        all_para_vec_dict = {}
-        for i, para in enumerate(self.paraids):
-            all_para_vec_dict[para] = self.paravecs_npy[i]
-        X = []
+    def build_page_data(self, qid, paralist):
+        '''
+        Returns the context vec Xq of shape (v) and the para vecs Xp of shape (m X v) of the sorted paralist, to be
+        scored with CATSSimilarityModel.score_page. Para pairs follow the same order as in build_cluster_data.
+        '''
         if qid not in self.query_vecs.keys():
             print(qid+' not present in query vecs dict')
             return None
-        parapairs = []
         paralist.sort()
-        for i in range(len(paralist)-1):
-            for j in range(i+1, len(paralist)):
-                p1 = paralist[i]
-                p2 = paralist[j]
-                row = np.hstack((self.query_vecs[qid], all_para_vec_dict[p1], all_para_vec_dict[p2]))
-                X.append(row)
-                parapairs.append(p1+'_'+p2)
-        X = torch.tensor(X)
+        Xq = torch.as_tensor(self.query_vecs[qid], dtype=torch.float)
+        Xp = torch.as_tensor(self.para_store.get(paralist), dtype=torch.float)
+        return Xq, Xp
+
+    def build_cluster_data(self, qid, paralist):
+        if qid not in self.query_vecs.keys():
+            print(qid+' not present in query vecs dict')
+            return None
+        Xq, Xp = self.build_page_data(qid, paralist)
+        i, j = torch.triu_indices(len(paralist), len(paralist), 1)
+        X = torch.cat((Xq.unsqueeze(0).expand(i.shape[0], -1), Xp[i], Xp[j]), 1)
+        parapairs = [paralist[a]+'_'+paralist[b] for a, b in zip(i.tolist(), j.tolist())]
         #print(qid+' X shape: '+str(X.shape))
         return X, parapairs
 
-class InputSentenceCATSDatasetBuilder:
+def pad_sentences(sent_vecs, spans, max_seq_len):
+    '''
+    Pads the sentence vecs of each para into a single array of shape (P X max_seq_len X v+1). Para k takes the rows
+    spans[k, 0]:spans[k, 0] + spans[k, 1] of sent_vecs, cut or zero padded to max_seq_len, and the last column holds
+    the valid bit of each sentence slot.
+
+    :param sent_vecs: sentence vecs of shape (S X v), usually the memory mapped vecs of a sentence-wise EmbeddingStore
+    :param spans: int array of shape (P X 2) of (start, count) of each para as returned by EmbeddingStore.spans
+    :param max_seq_len: number of sentence slots per para
+    :return: float32 ndarray of shape (P X max_seq_len X v+1)
+    '''
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    emb_len = sent_vecs.shape[1]
+    valid = np.arange(max_seq_len)[None, :] < np.minimum(spans[:, 1], max_seq_len)[:, None]
+    rows = (spans[:, 0][:, None] + np.arange(max_seq_len)[None, :])[valid]
+    padded = np.zeros((spans.shape[0], max_seq_len, emb_len + 1), dtype=np.float32)
+    padded[:, :, :emb_len][valid] = to_float32(sent_vecs[rows])
+    padded[:, :, emb_len] = valid
+    return padded
+
+def pack_sentences(sent_vecs, spans, max_seq_len):
+    '''
+    Packed counterpart of pad_sentences: copies the first max_seq_len sentence vecs of each para one after the other
+    into a flat matrix without padding.
+
+    :param sent_vecs: sentence vecs of shape (S X v)
+    :param spans: int array of shape (P X 2) of (start, count) of each para as returned by EmbeddingStore.spans
+    :param max_seq_len: max number of sentences kept per para
+    :return: float32 ndarray of shape (N X v) and the int64 starts and lengths of shape (P) of each para in it
+    '''
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    lengths = np.minimum(spans[:, 1], max_seq_len)
+    starts = np.cumsum(lengths) - lengths
+    rows = np.repeat(spans[:, 0] - starts, lengths) + np.arange(lengths.sum())
+    return to_float32(sent_vecs[rows]).reshape(-1, sent_vecs.shape[1]), starts, lengths
+
+class SentencePairDataset(Dataset):
     '''
-        query_attn_data: [[query ID, para1 ID, para2 ID, int label], ....]
+    Sentence-wise counterpart of CATSPairDataset. Pairs are int index arrays (qidx, pidx1, pidx2) into the query vecs
+    and the padded para sentences of pad_sentences, and indexing gathers Xq of shape (b X v), Xp of shape
+    (b X 2*(v+1) X max_seq_len), laid out as [para1 sentences, para2 sentences] like the old per pair padding, and y
+    of shape (b)
+    '''
+    def __init__(self, qidx, pidx1, pidx2, labels, qvecs, para_sents):
+        self.qidx = torch.as_tensor(qidx, dtype=torch.long)
+        self.pidx1 = torch.as_tensor(pidx1, dtype=torch.long)
+        self.pidx2 = torch.as_tensor(pidx2, dtype=torch.long)
+        self.labels = torch.as_tensor(labels, dtype=torch.float)
+        self.qvecs = torch.as_tensor(qvecs, dtype=torch.float)
+        self.para_sents = storage_tensor(para_sents)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __getitem__(self, idx):
+        single = isinstance(idx, int)
+        if isinstance(idx, slice):
+            idx = torch.arange(len(self))[idx]
+        idx = torch.as_tensor(idx, dtype=torch.long).reshape(-1)
+        Xq = self.qvecs.index_select(0, self.qidx[idx])
+        Xp = torch.cat((self.para_sents.index_select(0, self.pidx1[idx]).float(),
+                        self.para_sents.index_select(0, self.pidx2[idx]).float()), 2).transpose(1, 2)
+        y = self.labels[idx]
+        if single:
+            return Xq[0], Xp[0], y[0]
+        return Xq, Xp, y
+
+    def subset(self, idx):
         '''
+        Returns a dataset of the selected pairs sharing the same query vecs and para sentences
+        '''
+        return SentencePairDataset(self.qidx[idx], self.pidx1[idx], self.pidx2[idx], self.labels[idx], self.qvecs,
+                                   self.para_sents)
+
+    def save(self, cache, name):
+        cache.save(name, qidx=self.qidx, pidx1=self.pidx1, pidx2=self.pidx2, labels=self.labels, qvecs=self.qvecs,
+                   para_sents=self.para_sents)
 
-    def __init__(self, query_attn_data, paraids_npy, paravecs_npy, queryids_npy, queryvecs_npy, max_seq_len=5):
+    @staticmethod
+    def load(cache, name):
+        return SentencePairDataset(**cache.load(name))
+
+class PackedSentencePairDataset(Dataset):
+    '''
+    Packed counterpart of SentencePairDataset for the forward_packed mode of the sentence attention models. The para
+    sentences are kept as one flat matrix with the starts and lengths of each para (see pack_sentences). Indexing
+    gathers only the sentences of the paras in the batch and returns (Xq, sents, starts1, lengths1, starts2,
+    lengths2, y), where the spans point into the batch's sents. An int index gives a batch of one pair.
+    '''
+    def __init__(self, qidx, pidx1, pidx2, labels, qvecs, sents, starts, lengths):
+        self.qidx = torch.as_tensor(qidx, dtype=torch.long)
+        self.pidx1 = torch.as_tensor(pidx1, dtype=torch.long)
+        self.pidx2 = torch.as_tensor(pidx2, dtype=torch.long)
+        self.labels = torch.as_tensor(labels, dtype=torch.float)
+        self.qvecs = torch.as_tensor(qvecs, dtype=torch.float)
+        self.sents = storage_tensor(sents)
+        self.starts = torch.as_tensor(starts, dtype=torch.long)
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = torch.arange(len(self))[idx]
+        idx = torch.as_tensor(idx, dtype=torch.long).reshape(-1)
+        b = idx.shape[0]
+        paras = torch.cat((self.pidx1[idx], self.pidx2[idx]))
+        lengths = self.lengths[paras]
+        starts = torch.cumsum(lengths, 0) - lengths
+        rows = torch.repeat_interleave(self.starts[paras] - starts, lengths) + torch.arange(int(lengths.sum()))
+        sents = self.sents.index_select(0, rows).float()
+        Xq = self.qvecs.index_select(0, self.qidx[idx])
+        return Xq, sents, starts[:b], lengths[:b], starts[b:], lengths[b:], self.labels[idx]
+
+    def subset(self, idx):
+        '''
+        Returns a dataset of the selected pairs sharing the same query vecs and packed sentences
+        '''
+        return PackedSentencePairDataset(self.qidx[idx], self.pidx1[idx], self.pidx2[idx], self.labels[idx],
+                                         self.qvecs, self.sents, self.starts, self.lengths)
+
+    def save(self, cache, name):
+        cache.save(name, qidx=self.qidx, pidx1=self.pidx1, pidx2=self.pidx2, labels=self.labels, qvecs=self.qvecs,
+                   sents=self.sents, starts=self.starts, lengths=self.lengths)
+
+    @staticmethod
+    def load(cache, name):
+        return PackedSentencePairDataset(**cache.load(name))
+
+class PairStream(IterableDataset):
+    '''
+    Streaming counterpart of the pair datasets for training sets that do not fit in RAM. Pairs are kept only as row
+    numbers into the memory mapped EmbeddingStores and the vecs of each batch are read from the stores when the batch
+    is produced, in the DataLoader workers if there are any. float16 and bfloat16 vecs files (see save_vecs) are
+    upcast to float32 batch by batch. Batches have the layout of CATSPairDataset (X, y), or,
+    for a sentence-wise para_store and max_seq_len, of SentencePairDataset (Xq, Xp, y) or with packed of
+    PackedSentencePairDataset.
+
+    Iterating yields the full batches of one epoch, shuffled with a permutation seeded by seed and the epoch number
+    given to set_epoch, and split among the DataLoader workers.
+    '''
+    def __init__(self, qrows, prows1, prows2, labels, query_store, para_store, batch_size, shuffle=True,
+                 max_seq_len=None, packed=False, seed=42):
+        self.qrows = np.asarray(qrows, dtype=np.int64)
+        self.prows1 = np.asarray(prows1, dtype=np.int64)
+        self.prows2 = np.asarray(prows2, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.float32)
+        self.query_store = query_store
+        self.para_store = para_store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.max_seq_len = max_seq_len
+        self.packed = packed
+        self.seed = seed
+        self.epoch = 0
+
+    @staticmethod
+    def from_qry_attn(query_attn_data, query_store, para_store, batch_size, shuffle=True, max_seq_len=None,
+                      packed=False):
+        '''
+        Pairs of query_attn_data in the same order as the build_index_data of the dataset builders, pairs whose query
+        is not in query_store are left out
+        '''
+        qids = np.array([d[0] for d in query_attn_data])
+        present = query_store.contains(qids)
+        if not present.all():
+            print(str(len(set(qids[~present].tolist())))+' queries of the qry_attn data are not in the query vecs')
+        dat = [d for i, d in enumerate(query_attn_data) if present[i]]
+        return PairStream(query_store.rows(qids[present]), para_store.rows([d[1] for d in dat]),
+                          para_store.rows([d[2] for d in dat]), [float(d[3]) for d in dat], query_store, para_store,
+                          batch_size, shuffle, max_seq_len, packed)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def subset(self, idx):
+        '''
+        Returns a stream of the selected pairs reading from the same stores
+        '''
+        return PairStream(self.qrows[idx], self.prows1[idx], self.prows2[idx], self.labels[idx], self.query_store,
+                          self.para_store, self.batch_size, self.shuffle, self.max_seq_len, self.packed, self.seed)
+
+    def __getitem__(self, idx):
+        '''
+        Reads the batch of the pairs idx (index array or slice) from the stores, laid out like the batches of the
+        iteration
+        '''
+        idx = np.arange(len(self))[idx].reshape(-1)
+        b = idx.shape[0]
+        Xq = torch.from_numpy(self.query_store.gather(self.qrows[idx]))
+        y = torch.as_tensor(self.labels[idx])
+        prows = np.concatenate((self.prows1[idx], self.prows2[idx]))
+        if self.max_seq_len is None:
+            Xp = torch.from_numpy(self.para_store.gather(prows))
+            return torch.cat((Xq, Xp[:b], Xp[b:]), 1), y
+        spans = np.asarray(self.para_store.ids[prows, 1:]).astype(np.int64)
+        if self.packed:
+            sents, starts, lengths = pack_sentences(self.para_store.vecs, spans, self.max_seq_len)
+            starts = torch.as_tensor(starts)
+            lengths = torch.as_tensor(lengths)
+            return Xq, torch.as_tensor(sents), starts[:b], lengths[:b], starts[b:], lengths[b:], y
+        para_sents = torch.as_tensor(pad_sentences(self.para_store.vecs, spans, self.max_seq_len))
+        return Xq, torch.cat((para_sents[:b], para_sents[b:]), 2).transpose(1, 2), y
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(len(self))
+        else:
+            order = np.arange(len(self))
+        worker = get_worker_info()
+        first, step = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        for b in range(first, len(self) // self.batch_size, step):
+            yield self[order[b * self.batch_size:(b + 1) * self.batch_size]]
+
+def pair_loader(dataset, batch_size, num_workers=0, shuffle=True):
+    '''
+    DataLoader yielding whole batches of a pair dataset (CATSPairDataset, SentencePairDataset,
+    PackedSentencePairDataset) or of a PairStream. Map style datasets are gathered one batch per index list, reshuffled
+    every epoch if shuffle, and the last incomplete batch is dropped like in the PairStream. With num_workers > 0 the
+    batches are gathered in worker processes while the model trains, and pinned when training on cuda so they can be
+    copied with non_blocking=True.
+    '''
+    pin = torch.cuda.is_available()
+    if isinstance(dataset, IterableDataset):
+        return DataLoader(dataset, batch_size=None, num_workers=num_workers, pin_memory=pin)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=True),
+                      num_workers=num_workers, pin_memory=pin, persistent_workers=num_workers > 0)
+
+class InputSentenceCATSDatasetBuilder:
+    '''
+    query_attn_data: [[query ID, para1 ID, para2 ID, int label], ....]
+    sent_store: sentence-wise EmbeddingStore, query_store: EmbeddingStore of the query vecs
+    The sentences of every para in query_attn_data are padded once into self.para_sents (see pad_sentences), or
+    packed once for build_packed_index_data, and the pairs are gathered from it by index. vec_dtype is the dtype the
+    padded or packed sentences are held in, see storage_tensor.
+    '''
+
+    def __init__(self, query_attn_data, sent_store, query_store, max_seq_len=5, vec_dtype=None):
         paralist = []
         querylist = []
         for data in query_attn_data:
             querylist.append(data[0])
             paralist.append(data[1])
             paralist.append(data[2])
-        paraids = list(paraids_npy)
-        assert set(paralist).issubset(set([p[0] for p in paraids])) is True
-        self.paraids_dict = {}
-        for i in range(len(paraids)):
-            self.paraids_dict[paraids[i][0]] = [int(paraids[i][1]), int(paraids[i][2])]
-        self.paravecs_npy = paravecs_npy
-        self.queryids = list(queryids_npy)
-        self.queryvecs_npy = queryvecs_npy
-        self.query_attn_data = query_attn_data
+        paralist = sorted(set(paralist))
+        querylist = list(set(querylist))
+        assert sent_store.contains(paralist).all()
+        self.sent_store = sent_store
         self.max_seq_len = max_seq_len
+        self.vec_dtype = vec_dtype
         self.emb_len = 768
+        self.para_pos = {p: i for i, p in enumerate(paralist)}
+        self.para_spans = sent_store.spans(paralist)
+        self.para_sents = None
+        self.query_store = query_store
+        querylist = [q for q in querylist if q in query_store]
+        self.query_vecs = dict(zip(querylist, query_store.get(querylist)))
+        self.query_attn_data = query_attn_data
 
-        self.query_indices = {}
-        for i in range(len(self.queryids)):
-            self.query_indices[self.queryids[i]] = i
+    def _padded_sents(self):
+        if self.para_sents is None:
+            self.para_sents = storage_tensor(pad_sentences(self.sent_store.vecs, self.para_spans, self.max_seq_len),
+                                             self.vec_dtype)
+        return self.para_sents
 
-    def build_input_data(self, qry_attn_dat=None):
-        Xq = []
-        Xp = []
+    def _pair_index(self, qry_attn_dat):
+        query_index = {}
+        qidx = []
+        pidx1 = []
+        pidx2 = []
         y = []
-        if qry_attn_dat == None:
-            qry_attn_dat = self.query_attn_data
-        samples = len(qry_attn_dat)
-        i = 0
         pairs = []
         for qid, pid1, pid2, label in qry_attn_dat:
-            if qid in self.query_indices.keys():
-                # row = np.hstack((self.query_vecs[qid], self.para_vecs[pid1], self.para_vecs[pid2]))
-                qvec = self.queryvecs_npy[self.query_indices[qid]]
-                p1index_dat = self.paraids_dict[pid1]
-                p1mat = self.paravecs_npy[p1index_dat[0]:p1index_dat[0] + p1index_dat[1]]
-                p1vec_len = p1mat.shape[0]
-                if p1vec_len < self.max_seq_len:
-                    valid_bits = np.array([1.0] * p1vec_len + [0.0] * (self.max_seq_len - p1vec_len)).reshape((-1,1))
-                    z = np.zeros((self.max_seq_len - p1vec_len, self.emb_len))
-                    p1mat = np.hstack((np.vstack((p1mat, z)), valid_bits))
-                else:
-                    valid_bits = np.array([1.0] * self.max_seq_len).reshape((-1,1))
-                    p1mat = np.hstack((p1mat[:self.max_seq_len], valid_bits))
-
-                p2index_dat = self.paraids_dict[pid2]
-                p2mat = self.paravecs_npy[p2index_dat[0]:p2index_dat[0] + p2index_dat[1]]
-                p2vec_len = p2mat.shape[0]
-                if p2vec_len < self.max_seq_len:
-                    valid_bits = np.array([1.0] * p2vec_len + [0.0] * (self.max_seq_len - p2vec_len)).reshape((-1,1))
-                    p2mat = np.hstack(
-                        (np.vstack((p2mat, np.zeros((self.max_seq_len - p2vec_len, self.emb_len)))), valid_bits))
-                else:
-                    valid_bits = np.array([1.0] * self.max_seq_len).reshape((-1,1))
-                    p2mat = np.hstack((p2mat[:self.max_seq_len], valid_bits))
-                dat_mat = np.hstack((p1mat, p2mat))
-
+            if qid in self.query_vecs.keys():
+                qidx.append(query_index.setdefault(qid, len(query_index)))
+                pidx1.append(self.para_pos[pid1])
+                pidx2.append(self.para_pos[pid2])
                 y.append(float(label))
-                Xq.append(qvec)
-                Xp.append(dat_mat.transpose())
                 if pid1 < pid2:
                     pairs.append(pid1+'_'+pid2)
                 else:
                     pairs.append(pid2+'_'+pid1)
-                i += 1
-                if i % 10000 == 0:
-                    print(str(i) + ' samples processed out of '+str(samples))
-        Xq = np.array(Xq)
-        Xp = np.array(Xp)
-        #print('numpy conversion done')
-        Xq = torch.as_tensor(Xq, dtype=torch.float)
-        Xp = torch.as_tensor(Xp, dtype=torch.float)
-        y = torch.tensor(y)
+        qvecs = np.array([self.query_vecs[q] for q in query_index.keys()], dtype=np.float32).reshape(len(query_index), -1)
+        return np.array(qidx, dtype=np.int64), np.array(pidx1, dtype=np.int64), np.array(pidx2, dtype=np.int64), \
+               np.array(y), qvecs, pairs
+
+    def build_index_data(self, qry_attn_dat=None):
+        '''
+        Same pairs as build_input_data but returned as a SentencePairDataset that gathers the padded sentences of each
+        batch from self.para_sents
+        '''
+        if qry_attn_dat is None:
+            qry_attn_dat = self.query_attn_data
+        qidx, pidx1, pidx2, y, qvecs, _ = self._pair_index(qry_attn_dat)
+        return SentencePairDataset(qidx, pidx1, pidx2, y, qvecs, self._padded_sents())
+
+    def build_packed_index_data(self, qry_attn_dat=None):
+        '''
+        Same pairs as build_index_data but returned as a PackedSentencePairDataset for the forward_packed mode of the
+        sentence models, the para sentences are packed without padding
+        '''
+        if qry_attn_dat is None:
+            qry_attn_dat = self.query_attn_data
+        qidx, pidx1, pidx2, y, qvecs, _ = self._pair_index(qry_attn_dat)
+        sents, starts, lengths = pack_sentences(self.sent_store.vecs, self.para_spans, self.max_seq_len)
+        return PackedSentencePairDataset(qidx, pidx1, pidx2, y, qvecs, storage_tensor(sents, self.vec_dtype), starts,
+                                         lengths)
+
+    def build_input_data(self, qry_attn_dat=None):
+        if qry_attn_dat is None:
+            qry_attn_dat = self.query_attn_data
+        qidx, pidx1, pidx2, y, qvecs, pairs = self._pair_index(qry_attn_dat)
+        Xq, Xp, y = SentencePairDataset(qidx, pidx1, pidx2, y, qvecs, self._padded_sents())[:]
         #print('Xq shape: ' + str(Xq.shape) + ', Xp shape: ' + str(Xp.shape) + ', y shape: ' + str(y.shape))
         return Xq, Xp, y, pairs
 
+    def build_page_data(self, qid, paralist):
+        '''
+        Returns the context vec Xq of shape (v) and the padded sentences Xp of shape (m X v+1 X max_seq_len) of each
+        para of the sorted paralist, to be scored with the score_page of the sentence models. Para pairs follow the
+        same order as in build_cluster_data.
+        '''
+        if qid not in self.query_store:
+            print(qid + ' not present in query vecs dict')
+            return None
+        paralist.sort()
+        Xq = torch.as_tensor(self.query_store.get([qid])[0], dtype=torch.float)
+        Xp = torch.as_tensor(pad_sentences(self.sent_store.vecs, self.sent_store.spans(paralist), self.max_seq_len))
+        return Xq, Xp.transpose(1, 2)
+
     def build_cluster_data(self, qid, paralist):
-        if qid not in self.query_indices.keys():
+        if qid not in self.query_store:
             print(qid + ' not present in query vecs dict')
             return None
-        Xq = []
-        Xp = []
+        m = len(paralist)
+        qvec = torch.as_tensor(self.query_store.get([qid])[0], dtype=torch.float)
+        para_sents = torch.as_tensor(pad_sentences(self.sent_store.vecs, self.sent_store.spans(paralist),
+                                                   self.max_seq_len))
+        i, j = torch.triu_indices(m, m, 1)
+        Xq = qvec.unsqueeze(0).expand(i.shape[0], -1)
+        Xp = torch.cat((para_sents[i], para_sents[j]), 2).transpose(1, 2)
         pairs = []
-        for i in range(len(paralist) - 1):
-            for j in range(i + 1, len(paralist)):
-                pid1 = paralist[i]
-                pid2 = paralist[j]
-
-                qvec = self.queryvecs_npy[self.query_indices[qid]]
-                p1index_dat = self.paraids_dict[pid1]
-                p1mat = self.paravecs_npy[p1index_dat[0]:p1index_dat[0] + p1index_dat[1]]
-                p1vec_len = p1mat.shape[0]
-                if p1vec_len < self.max_seq_len:
-                    valid_bits = np.array([1.0] * p1vec_len + [0.0] * (self.max_seq_len - p1vec_len)).reshape((-1, 1))
-                    z = np.zeros((self.max_seq_len - p1vec_len, self.emb_len))
-                    p1mat = np.hstack((np.vstack((p1mat, z)), valid_bits))
-                else:
-                    valid_bits = np.array([1.0] * self.max_seq_len).reshape((-1, 1))
-                    p1mat = np.hstack((p1mat[:self.max_seq_len], valid_bits))
-
-                p2index_dat = self.paraids_dict[pid2]
-                p2mat = self.paravecs_npy[p2index_dat[0]:p2index_dat[0] + p2index_dat[1]]
-                p2vec_len = p2mat.shape[0]
-                if p2vec_len < self.max_seq_len:
-                    valid_bits = np.array([1.0] * p2vec_len + [0.0] * (self.max_seq_len - p2vec_len)).reshape((-1, 1))
-                    p2mat = np.hstack(
-                        (np.vstack((p2mat, np.zeros((self.max_seq_len - p2vec_len, self.emb_len)))), valid_bits))
-                else:
-                    valid_bits = np.array([1.0] * self.max_seq_len).reshape((-1, 1))
-                    p2mat = np.hstack((p2mat[:self.max_seq_len], valid_bits))
-                dat_mat = np.hstack((p1mat, p2mat))
-
-                Xq.append(qvec)
-                Xp.append(dat_mat.transpose())
-                if pid1 < pid2:
-                    pairs.append(pid1 + '_' + pid2)
-                else:
-                    pairs.append(pid2 + '_' + pid1)
-        Xq = np.array(Xq)
-        Xp = np.array(Xp)
-        Xq = torch.as_tensor(Xq, dtype=torch.float)
-        Xp = torch.as_tensor(Xp, dtype=torch.float)
+        for a, b in zip(i.tolist(), j.tolist()):
+            if paralist[a] < paralist[b]:
+                pairs.append(paralist[a] + '_' + paralist[b])
+            else:
+                pairs.append(paralist[b] + '_' + paralist[a])
         return Xq, Xp, pairs
 
 
-
-def query_embedder(query_list, embedding_model):
-    query_embed = {}
-    queries = []
-    query_ids = []
-    for q in query_list:
-        hash = sha1(str.encode(q)).hexdigest()
-        if 'Query:'+hash not in query_ids:
-            query_ids.append('Query:'+hash)
-            queries.append(q)
-    model = SentenceTransformer(embedding_model)
-    query_vecs = model.encode(queries, show_progress_bar=True)
-    for i in range(len(query_ids)):
-        query_embed[query_ids[i]] = {'query': queries[i], 'query_vec': query_vecs[i]}
-    return query_embed
+def query_embedder(query_list, embedding_model, cache_dir=None, batch_size=32, processes=0):
+    '''
+    {query ID: {'query': query, 'query_vec': vec}} of the distinct queries of query_list, see
+    query_embedding.embed_queries for the cache and encoding options
+    '''
+    queries = list(dict.fromkeys(query_list))
+    query_ids, query_vecs = embed_queries(queries, embedding_model, cache_dir, batch_size, processes)
+    return {query_ids[i]: {'query': queries[i], 'query_vec': query_vecs[i]} for i in range(len(queries))}
 
 def rewrite_qry_attn_with_qryID(old_qry_attn_file, output_file):
     with open(old_qry_attn_file, 'r') as sq:
@@ -311,32 +596,20 @@ def rewrite_qry_attn_with_qryID(old_qry_attn_file, output_file):
             out.write(l)
 
 def read_art_qrels(art_qrels):
-    page_paras = {}
-    with open(art_qrels, 'r') as f:
-        for l in f:
-            q = l.split(' ')[0]
-            p = l.split(' ')[2]
-            if q not in page_paras.keys():
-                page_paras[q] = [p]
-            else:
-                page_paras[q].append(p)
-    return page_paras
+    '''
+    Dict of page -> list of its para IDs in file order
+    '''
+    qrels = Qrels(art_qrels)
+    return {page: qrels.paras(page) for page in qrels}
 
 def main():
     qry_attn_file = '/home/sk1105/sumanta/CATS_data/half-y1train-qry-attn.tsv'
-    pids_npy = np.load('/home/sk1105/sumanta/CATS_data/half-y1train-qry-attn-paraids-sentwise.npy')
-    pvecs_npy = np.load('/home/sk1105/sumanta/CATS_data/half-y1train-qry-attn-paravecs-sentwise.npy')
-    qids_npy = np.load('/home/sk1105/sumanta/CATS_data/half-y1train-context-qids.npy')
-    qvecs_npy = np.load('/home/sk1105/sumanta/CATS_data/half-y1train-context-qvecs.npy')
-    qry_attn = []
-    with open(qry_attn_file, 'r') as trf:
-        f = True
-        for l in trf:
-            if f:
-                f = False
-                continue
-            qry_attn.append(l.split('\t'))
-    dat = InputSentenceCATSDatasetBuilder(qry_attn, pids_npy, pvecs_npy, qids_npy, qvecs_npy)
+    sent_store = EmbeddingStore('/home/sk1105/sumanta/CATS_data/half-y1train-qry-attn-paraids-sentwise.npy',
+                                '/home/sk1105/sumanta/CATS_data/half-y1train-qry-attn-paravecs-sentwise.npy')
+    query_store = EmbeddingStore('/home/sk1105/sumanta/CATS_data/half-y1train-context-qids.npy',
+                                 '/home/sk1105/sumanta/CATS_data/half-y1train-context-qvecs.npy')
+    qry_attn = QryAttn.load(qry_attn_file)
+    dat = InputSentenceCATSDatasetBuilder(qry_attn, sent_store, query_store)
     Xq, Xp, y = dat.build_input_data()
 
 if __name__ == '__main__':
@@ -1,25 +1,31 @@
 from sklearn.metrics import roc_auc_score, adjusted_rand_score, f1_score
 from sklearn.feature_extraction.text import TfidfVectorizer
-from data.utils import read_art_qrels, InputCATSDatasetBuilder
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.preprocessing import normalize
+from data.utils import InputCATSDatasetBuilder
+from data.qrels import read_cluster_qrels
+from data.embedding_store import EmbeddingStore
+from data.cache import cache_key
+from data.qry_attn import QryAttn
+from eval.clustering import dist_matrix, euclid_scores, average_linkage, cut_clusters
+import os
+import pickle
 import numpy as np
+from scipy import sparse
 import json
 from hashlib import sha1
-import math
 import torch
 from scipy.stats import ttest_rel
-from scipy.special import kl_div
+from scipy.special import rel_entr
 import argparse
-from nltk.corpus import stopwords
 from collections import defaultdict
-from gensim import corpora
-from gensim.models import ldamodel
-
-tfidf_vec_dict = {}
-lda_tm_topic_dist = {}
-num_topics=200 #for topic model
 
 def lda_topic_model(test_ptext_path, train_token_dict_path, trained_model_path):
+    '''
+    TopicBaseline of the LDA topic distributions of the paras of a paratext tsv
+    '''
+    from nltk.corpus import stopwords
+    from gensim import corpora
+    from gensim.models import ldamodel
     ptext_dict = {}
     with open(test_ptext_path, 'r') as f:
         for l in f:
@@ -37,9 +43,13 @@ def lda_topic_model(test_ptext_path, train_token_dict_path, trained_model_path):
             frequency[t] += 1
     texts = [[t for t in doc if frequency[t] > 1] for doc in pre_docs]
     unseen_corpus = [token_dict.doc2bow(text) for text in texts]
+    topics = np.zeros((len(paraids), model.num_topics), dtype=np.float32)
     for p in range(len(paraids)):
         topic_vec = model[unseen_corpus[p]]
-        lda_tm_topic_dist[paraids[p]] = [(t[0], float(t[1])) for t in topic_vec]
+        if len(topic_vec) > 0:
+            t, prob = zip(*topic_vec)
+            topics[p, list(t)] = prob
+    return TopicBaseline(paraids, topics)
 
 def calc_f1(y_true, y_pred):
     y_true = np.array(y_true)
@@ -55,56 +65,89 @@ def jaccard(p1text, p2text):
     c = a.intersection(b)
     return float(len(c)) / (len(a) + len(b) - len(c))
 
-def kldiv(a, b):
-    score = 0
-    for s in kl_div(a, b):
-        if s != float("inf"):
-            score += s
-    return score
-
-def sparse_jsdiv_score(p1, p2):
-    v1 = lda_tm_topic_dist[p1]
-    v2 = lda_tm_topic_dist[p2]
-    x = [0] * num_topics
-    for v in v1:
-        x[v[0]] = v[1]
-    y = [0] * num_topics
-    for v in v2:
-        y[v[0]] = v[1]
-    m = [(x[i]+y[i])/2 for i in range(num_topics)]
-    kldiv1 = kldiv(x, m)
-    kldiv2 = kldiv(y, m)
-    return (kldiv1 + kldiv2)/2
-
-def tfidf_cosine_similarity(pid1, pid2, paratext_dict):
-    if pid1 not in tfidf_vec_dict.keys():
-        pid_list = list(paratext_dict.keys())
-        corpus = []
-        for i in range(len(pid_list)):
-            corpus.append(paratext_dict[pid_list[i]].strip())
-        tfidf = TfidfVectorizer()
-        vecs = tfidf.fit_transform(corpus).toarray()
-        for i in range(len(pid_list)):
-            tfidf_vec_dict[pid_list[i]] = vecs[i]
-    a = tfidf_vec_dict[pid1]
-    b = tfidf_vec_dict[pid2]
-    score = np.dot(a,b)/(np.sqrt(np.sum(a**2))*np.sqrt(np.sum(b**2)))
-    if math.isnan(score):
-        return 0.0
-    else:
-        return score
-
-def eval_all_pairs(parapairs_data, test_ptext_file, test_pids_file, test_pvecs_file, test_qids_file, test_qvecs_file):
-    ptext_dict = {}
-    with open(test_ptext_file, 'r') as f:
-        for l in f:
-            if len(l.split('\t')) > 1:
-                ptext_dict[l.split('\t')[0]] = l.split('\t')[1].strip()
-
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
+class TfidfBaseline:
+    '''
+    TF-IDF cosine similarity of the paras of a paratext tsv. The TF-IDF vecs of all paras are kept as one CSR matrix
+    with L2 normalized rows, so the similarity of a list of pairs is a row-wise product and that of all pairs of a page
+    one sparse (m X m) product, without ever densifying the vocabulary-wide vecs. The vectorizer is fit once on the
+    same corpus as the paratext dicts of the evaluators, every line with a text column, so the idf and the scores are
+    those of the dense per-pair scorer it replaces (paras with an empty text score 0, paras without a text column
+    raise KeyError). It is pickled with the matrix
+    under cache_dir, keyed on the paratext file like FeatureCache, so later runs on the same file load both instead
+    of fitting again.
+    '''
+    def __init__(self, ptext_file, cache_dir='tfidf_cache'):
+        ptext_dict = {}
+        with open(ptext_file, 'r') as f:
+            for l in f:
+                if len(l.split('\t')) > 1:
+                    ptext_dict[l.split('\t')[0]] = l.split('\t')[1].strip()
+        self.para_index = {p: i for i, p in enumerate(ptext_dict)}
+        path = os.path.join(cache_dir, cache_key([ptext_file], 'all lines with text'))
+        if os.path.isfile(path + '.vecs.npz'):
+            with open(path + '.vectorizer.pkl', 'rb') as f:
+                self.vectorizer = pickle.load(f)
+            self.vecs = sparse.load_npz(path + '.vecs.npz').tocsr()
+        else:
+            self.vectorizer = TfidfVectorizer()
+            self.vecs = normalize(self.vectorizer.fit_transform(list(ptext_dict.values())), norm='l2',
+                                  copy=False).tocsr()
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(path + '.vectorizer.pkl', 'wb') as f:
+                pickle.dump(self.vectorizer, f)
+            sparse.save_npz(path + '.vecs.npz', self.vecs)
+
+    def _rows(self, paras):
+        return self.vecs[[self.para_index[p] for p in paras]]
+
+    def pair_scores(self, p1s, p2s):
+        '''
+        Similarity of each pair (p1s[i], p2s[i])
+        '''
+        return np.asarray(self._rows(p1s).multiply(self._rows(p2s)).sum(1)).reshape(-1)
+
+    def page_scores(self, paras):
+        '''
+        Condensed similarity of all pairs of paras, in the order of combinations(range(m), 2)
+        '''
+        X = self._rows(paras)
+        return (X @ X.T).toarray()[np.triu_indices(len(paras), 1)]
+
+class TopicBaseline:
+    '''
+    JS divergence of the LDA topic distributions of the paras, held as one (P X num_topics) float32 matrix with zeros
+    for the topics LDA leaves out, so the pairs of a page are scored with one vectorized rel_entr over the gathered
+    rows. The divergence is that of the unnormalized distributions, as LDA drops topics below its minimum probability.
+    '''
+    def __init__(self, para_ids, topics):
+        self.para_index = {p: i for i, p in enumerate(para_ids)}
+        self.topics = topics
+
+    def _rows(self, paras):
+        return self.topics[[self.para_index[p] for p in paras]].astype(np.float64)
+
+    def _jsdiv(self, x, y):
+        m = (x + y) / 2
+        return (rel_entr(x, m).sum(1) + rel_entr(y, m).sum(1)) / 2
+
+    def pair_scores(self, p1s, p2s):
+        '''
+        JS divergence of each pair (p1s[i], p2s[i])
+        '''
+        return self._jsdiv(self._rows(p1s), self._rows(p2s))
+
+    def page_scores(self, paras):
+        '''
+        Condensed JS divergence of all pairs of paras, in the order of combinations(range(m), 2)
+        '''
+        X = self._rows(paras)
+        pi, pj = np.triu_indices(len(paras), 1)
+        return self._jsdiv(X[pi], X[pj])
+
+def eval_all_pairs(parapairs_data, baseline, test_pids_file, test_pvecs_file, test_qids_file, test_qvecs_file):
+    test_paras = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
     with open(parapairs_data, 'r') as f:
         parapairs = json.load(f)
     anchor_auc = []
@@ -119,20 +162,17 @@ def eval_all_pairs(parapairs_data, test_ptext_file, test_pids_file, test_pvecs_f
             p2 = parapairs[page]['parapairs'][i].split('_')[1]
             qry_attn.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
 
-    test_data_builder = InputCATSDatasetBuilder(qry_attn, test_pids, test_pvecs, test_qids, test_qvecs)
+    test_data_builder = InputCATSDatasetBuilder(qry_attn, test_paras, test_queries)
     for page in parapairs.keys():
         qry_attn_ts = []
         qid = 'Query:' + sha1(str.encode(page)).hexdigest()
         y = []
-        y_baseline = []
         for i in range(len(parapairs[page]['parapairs'])):
             p1 = parapairs[page]['parapairs'][i].split('_')[0]
             p2 = parapairs[page]['parapairs'][i].split('_')[1]
             qry_attn_ts.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
             y.append(int(parapairs[page]['labels'][i]))
-            #y_baseline.append(tfidf_cosine_similarity(p1, p2, ptext_dict))
-            #y_baseline.append(jaccard(ptext_dict[p1], ptext_dict[p2]))
-            y_baseline.append(sparse_jsdiv_score(p1, p2))
+        y_baseline = baseline.pair_scores([r[1] for r in qry_attn_ts], [r[2] for r in qry_attn_ts])
         X_test, y_test = test_data_builder.build_input_data(qry_attn_ts)
         if len(set(y_test.cpu().numpy())) < 2:
             continue
@@ -158,56 +198,16 @@ def eval_all_pairs(parapairs_data, test_ptext_file, test_pids_file, test_pvecs_f
 
     return mean_auc, mean_euclid_auc, paired_ttest, mean_f1, mean_euclid_f1, paired_ttest_f1
 
-def eval_cluster(qry_attn_file_test, test_ptext_file, test_pids_file, test_pvecs_file, test_qids_file,
-                 test_qvecs_file, article_qrels, top_qrels, hier_qrels):
-    ptext_dict = {}
-    with open(test_ptext_file, 'r') as f:
-        for l in f:
-            if len(l.split('\t')) > 1:
-                ptext_dict[l.split('\t')[0]] = l.split('\t')[1].strip()
-    qry_attn_ts = []
-    with open(qry_attn_file_test, 'r') as tsf:
-        f = True
-        for l in tsf:
-            if f:
-                f = False
-                continue
-            qry_attn_ts.append(l.split('\t'))
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
-
-    test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_pids, test_pvecs, test_qids, test_qvecs)
-
-    page_paras = read_art_qrels(article_qrels)
-    para_labels = {}
-    with open(top_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels[para] = sec
-    page_num_sections = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels[p])
-        page_num_sections[page] = len(sec)
-
-    para_labels_hq = {}
-    with open(hier_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels_hq[para] = sec
-    page_num_sections_hq = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels_hq[p])
-        page_num_sections_hq[page] = len(sec)
+def eval_cluster(qry_attn_file_test, baseline, test_pids_file, test_pvecs_file, test_qids_file, test_qvecs_file,
+                 article_qrels, top_qrels, hier_qrels):
+    qry_attn_ts = QryAttn.load(qry_attn_file_test)
+    test_paras = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
+
+    test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_paras, test_queries)
+
+    pages, top, hier, page_num_sections, page_num_sections_hq = read_cluster_qrels(article_qrels, top_qrels,
+                                                                                   hier_qrels)
 
     anchor_auc = []
     cand_auc = []
@@ -218,17 +218,16 @@ def eval_cluster(qry_attn_file_test, test_ptext_file, test_pids_file, test_pvecs
     anchor_ari_scores_hq = []
     cand_ari_scores_hq = []
 
-    for page in page_paras.keys():
+    for page in pages:
         #print('Going to cluster '+page)
         qid = 'Query:'+sha1(str.encode(page)).hexdigest()
         if qid not in test_data_builder.query_vecs.keys():
             print(qid + ' not present in query vecs dict')
         else:
-            qry_attn_for_page = [d for d in qry_attn_ts if d[0]==qid]
+            qry_attn_for_page = qry_attn_ts.page(qid)
             X_test_page, y_test_page, page_pairs = test_data_builder.build_input_data_with_pairs(qry_attn_for_page)
-            #pair_scores_bal = [tfidf_cosine_similarity(pp.split('_')[0], pp.split('_')[1], ptext_dict) for pp in page_pairs]
-            #pair_scores_bal = [jaccard(ptext_dict[pp.split('_')[0]], ptext_dict[pp.split('_')[1]]) for pp in page_pairs]
-            pair_scores_bal = [sparse_jsdiv_score(pp.split('_')[0], pp.split('_')[1]) for pp in page_pairs]
+            pair_scores_bal = baseline.pair_scores([pp.split('_')[0] for pp in page_pairs],
+                                                   [pp.split('_')[1] for pp in page_pairs])
             pair_scores_bal = (pair_scores_bal - np.min(pair_scores_bal)) / (np.max(pair_scores_bal) - np.min(pair_scores_bal))
             test_auc_page = roc_auc_score(y_test_page, pair_scores_bal)
             cand_auc.append(test_auc_page)
@@ -242,51 +241,19 @@ def eval_cluster(qry_attn_file_test, test_ptext_file, test_pids_file, test_pvecs
             euclid_f1_page = calc_f1(y_test_page, y_euclid_page)
             anchor_f1.append(euclid_f1_page)
 
-            paralist = page_paras[page]
-            true_labels = []
-            true_labels_hq = []
-            paralist.sort()
-            for i in range(len(paralist)):
-                true_labels.append(para_labels[paralist[i]])
-                true_labels_hq.append(para_labels_hq[paralist[i]])
-            X_page, parapairs = test_data_builder.build_cluster_data(qid, paralist)
-            #pair_scores = [tfidf_cosine_similarity(pp.split('_')[0], pp.split('_')[1], ptext_dict) for pp in parapairs]
-            #pair_scores = [jaccard(ptext_dict[pp.split('_')[0]], ptext_dict[pp.split('_')[1]]) for pp in parapairs]
-            pair_scores = [sparse_jsdiv_score(pp.split('_')[0], pp.split('_')[1]) for pp in parapairs]
-            pair_scores = (pair_scores - np.min(pair_scores)) / (np.max(pair_scores) - np.min(pair_scores))
-            pair_euclid_scores = torch.sqrt(torch.sum((X_page[:, 768:768 * 2] - X_page[:, 768 * 2:])**2, 1)).numpy()
-            pair_euclid_scores = (pair_euclid_scores - np.min(pair_euclid_scores)) / (np.max(pair_euclid_scores) - np.min(pair_euclid_scores))
-            pair_score_dict = {}
-            pair_euclid_score_dict = {}
-            for i in range(len(parapairs)):
-                pair_score_dict[parapairs[i]] = 1 - pair_scores[i]
-                pair_euclid_score_dict[parapairs[i]] = pair_euclid_scores[i]
-            dist_mat = []
-            dist_euc_mat = []
-
-            for i in range(len(paralist)):
-                r = []
-                reuc = []
-                for j in range(len(paralist)):
-                    if i == j:
-                        r.append(0.0)
-                        reuc.append(0.0)
-                    elif i < j:
-                        r.append(pair_score_dict[paralist[i]+ '_' + paralist[j]])
-                        reuc.append(pair_euclid_score_dict[paralist[i] + '_' + paralist[j]])
-                    else:
-                        r.append(pair_score_dict[paralist[j] + '_' + paralist[i]])
-                        reuc.append(pair_euclid_score_dict[paralist[j] + '_' + paralist[i]])
-                dist_mat.append(r)
-                dist_euc_mat.append(reuc)
-
-            cl = AgglomerativeClustering(n_clusters=page_num_sections[page], affinity='precomputed', linkage='average')
-            cl_labels = cl.fit_predict(dist_mat)
-            cl_euclid_labels = cl.fit_predict(dist_euc_mat)
-
-            cl_hq = AgglomerativeClustering(n_clusters=page_num_sections_hq[page], affinity='precomputed', linkage='average')
-            cl_labels_hq = cl_hq.fit_predict(dist_mat)
-            cl_euclid_labels_hq = cl_hq.fit_predict(dist_euc_mat)
+            paralist = sorted(pages.paras(page))
+            para_codes = pages.codes(paralist)
+            true_labels = top.labels(para_codes)
+            true_labels_hq = hier.labels(para_codes)
+            Xq_page, Xp_page = test_data_builder.build_page_data(qid, paralist)
+            pair_scores = baseline.page_scores(paralist)
+            dist_mat = dist_matrix(pair_scores)
+            dist_euc_mat = dist_matrix(euclid_scores(Xp_page.numpy()), similarity=False)
+
+            g = pages.query_index[page]
+            num_clusters = [page_num_sections[g], page_num_sections_hq[g]]
+            cl_labels, cl_labels_hq = cut_clusters(average_linkage(dist_mat), num_clusters)
+            cl_euclid_labels, cl_euclid_labels_hq = cut_clusters(average_linkage(dist_euc_mat), num_clusters)
 
             ari_score = adjusted_rand_score(true_labels, cl_labels)
             ari_score_hq = adjusted_rand_score(true_labels_hq, cl_labels_hq)
@@ -330,6 +297,9 @@ def main():
     parser.add_argument('-dd', '--data_dir', default="/home/sk1105/sumanta/CATS_data/")
     parser.add_argument('-tm', '--topic_model', default="/home/sk1105/sumanta/CATS_data/topic_model/topic_model_half-y1train-qry-attn-t200.model")
     parser.add_argument('-td', '--token_dict', default="/home/sk1105/sumanta/CATS_data/topic_model/half-y1train-qry-attn-lda-tm-t200.tokendict")
+    parser.add_argument('-bl', '--baseline', default='topic', choices=['topic', 'tfidf'],
+                        help='LDA topic JS divergence or TF-IDF cosine similarity')
+    parser.add_argument('-tc', '--tfidf_cache', default='tfidf_cache', help='Directory of the fitted TF-IDF vectorizers')
 
     parser.add_argument('-qt1', '--qry_attn_test1', default="by1train-qry-attn-bal-allpos.tsv")
     parser.add_argument('-aql1', '--art_qrels1', default="/home/sk1105/sumanta/trec_dataset/benchmarkY1/benchmarkY1-train-nodup/train.pages.cbor-article.qrels")
@@ -371,18 +341,19 @@ def main():
     '''
     args = parser.parse_args()
     dat = args.data_dir
-    ##### for topic model#####
-    lda_topic_model(args.ptext_file1, args.token_dict, args.topic_model)
-    ##########################
+    if args.baseline == 'tfidf':
+        baseline = TfidfBaseline(args.ptext_file1, args.tfidf_cache)
+    else:
+        baseline = lda_topic_model(args.ptext_file1, args.token_dict, args.topic_model)
     print("\nPagewise benchmark Y1 train")
     print("===========================")
-    all_auc1, all_euc_auc1, ttest_auc1, all_fm1, all_euc_fm1, ttest_fm1 = eval_all_pairs(args.parapairs1, args.ptext_file1,
+    all_auc1, all_euc_auc1, ttest_auc1, all_fm1, all_euc_fm1, ttest_fm1 = eval_all_pairs(args.parapairs1, baseline,
                                                                       dat + args.test_pids1, dat + args.test_pvecs1,
                                                                       dat + args.test_qids1, dat + args.test_qvecs1)
 
     bal_auc1, bal_euc_auc1, mean_ari1, mean_euc_ari1, mean_ari1_hq, mean_euc_ari1_hq, \
     ttest1, ttest1_hq, ttest_bal_auc1, bal_fm1, bal_euc_fm1, ttest_bal_fm1 = eval_cluster(dat + args.qry_attn_test1,
-                                                                       args.ptext_file1,
+                                                                       baseline,
                                                                        dat + args.test_pids1,
                                                                        dat + args.test_pvecs1,
                                                                        dat + args.test_qids1,
@@ -390,18 +361,19 @@ def main():
                                                                        args.art_qrels1,
                                                                        args.top_qrels1,
                                                                        args.hier_qrels1)
-    ##### for topic model#####
-    lda_topic_model(args.ptext_file2, args.token_dict, args.topic_model)
-    ##########################
+    if args.baseline == 'tfidf':
+        baseline = TfidfBaseline(args.ptext_file2, args.tfidf_cache)
+    else:
+        baseline = lda_topic_model(args.ptext_file2, args.token_dict, args.topic_model)
     print("\nPagewise benchmark Y1 test")
     print("==========================")
-    all_auc2, all_euc_auc2, ttest_auc2, all_fm2, all_euc_fm2, ttest_fm2 = eval_all_pairs(args.parapairs2, args.ptext_file2,
+    all_auc2, all_euc_auc2, ttest_auc2, all_fm2, all_euc_fm2, ttest_fm2 = eval_all_pairs(args.parapairs2, baseline,
                                                         dat + args.test_pids2, dat + args.test_pvecs2,
                                                         dat + args.test_qids2, dat + args.test_qvecs2)
 
     bal_auc2, bal_euc_auc2, mean_ari2, mean_euc_ari2, mean_ari2_hq, mean_euc_ari2_hq, \
     ttest2, ttest2_hq, ttest_bal_auc2, bal_fm2, bal_euc_fm2, ttest_bal_fm2 = eval_cluster(dat + args.qry_attn_test2,
-                                                     args.ptext_file2,
+                                                     baseline,
                                                      dat + args.test_pids2,
                                                      dat + args.test_pvecs2,
                                                      dat + args.test_qids2,
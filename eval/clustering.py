@@ -0,0 +1,48 @@
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import linkage, cut_tree
+
+def dist_matrix(pair_scores, similarity=True):
+    '''
+    Turns the condensed pair scores of a page into the square (m X m) distance matrix used for clustering. The scores
+    must be in the order of combinations(range(m), 2), which is the order of CATSSimilarityModel.score_page and of
+    scipy's condensed distance vectors. Scores are min-max normalized and similarity scores are turned into distances
+    as 1 - score.
+
+    :param pair_scores: array of shape (mC2)
+    :param similarity: True if higher scores mean more similar paras
+    :return: symmetric ndarray of shape (m X m) with zero diagonal
+    '''
+    s = np.asarray(pair_scores, dtype=np.float64).reshape(-1)
+    s = (s - np.min(s)) / (np.max(s) - np.min(s))
+    if similarity:
+        s = 1 - s
+    return squareform(s, checks=False)
+
+def cosine_scores(Xp):
+    '''
+    Condensed cosine similarity of all pairs of rows of the para vecs Xp of shape (m X v)
+    '''
+    return 1 - pdist(np.asarray(Xp, dtype=np.float64), 'cosine')
+
+def euclid_scores(Xp):
+    '''
+    Condensed euclidean distance of all pairs of rows of the para vecs Xp of shape (m X v)
+    '''
+    return pdist(np.asarray(Xp, dtype=np.float64), 'euclidean')
+
+def average_linkage(dist_mat):
+    '''
+    Average linkage tree of a square distance matrix as returned by dist_matrix. The tree can be cut at any number of
+    clusters with cut_clusters without clustering again.
+    '''
+    return linkage(squareform(dist_mat, checks=False), method='average')
+
+def cut_clusters(tree, num_clusters):
+    '''
+    Flat cluster labels of shape (m) for each of the cluster counts in num_clusters, cut from an average_linkage tree
+    after its first m - k merges, so there are exactly k clusters even when merge heights tie, as with
+    AgglomerativeClustering(n_clusters=k)
+    '''
+    # one cut per k, cut_tree given several counts mislabels a cut with no merges (k = m)
+    return [cut_tree(tree, n_clusters=int(k))[:, 0] for k in num_clusters]
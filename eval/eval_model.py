@@ -1,7 +1,11 @@
 from model.layers import CATS, CATS_Scaled, CATS_QueryScaler, CATS_manhattan
 from model.models import CATSSimilarityModel
 from model.sent_models import CATSSentenceModel
-from data.utils import InputCATSDatasetBuilder, read_art_qrels
+from data.utils import InputCATSDatasetBuilder
+from data.qrels import read_cluster_qrels
+from data.embedding_store import EmbeddingStore
+from data.qry_attn import QryAttn
+from eval.clustering import dist_matrix, cosine_scores, euclid_scores, average_linkage, cut_clusters
 import torch
 torch.manual_seed(42)
 import torch.nn as nn
@@ -11,11 +15,12 @@ from numpy.random import seed
 seed(42)
 from hashlib import sha1
 from sklearn.metrics import roc_auc_score, adjusted_rand_score, f1_score
-from sklearn.cluster import AgglomerativeClustering, DBSCAN
 import argparse
 import math
 import time
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from scipy.stats import ttest_rel
 
 def calc_f1(y_true, y_pred):
@@ -26,12 +31,64 @@ def calc_f1(y_true, y_pred):
     test_f1 = f1_score(y_true, yp)
     return test_f1
 
+# State shared with the per-page workers. It is set before the pool is created so the forked workers inherit the
+# model and the memory mapped embedding stores read-only instead of receiving a pickled copy of them.
+_page_eval_state = {}
+
+def _init_page_worker():
+    # one intra-op thread per worker, the pages already keep all the cores busy
+    torch.set_num_threads(1)
+
+def map_pages(page_fn, pages, workers=1):
+    '''
+    Applies page_fn to every page and returns the results in the order of pages, so the merged per-page lists and the
+    means and t-tests computed from them are the same for any number of workers. With workers > 1 the pages are
+    sharded across a fork based ProcessPoolExecutor.
+    '''
+    pages = list(pages)
+    if workers <= 1 or len(pages) < 2:
+        return [page_fn(page) for page in pages]
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        print('fork is not available on this platform, evaluating pages in a single process')
+        return [page_fn(page) for page in pages]
+    chunksize = max(1, len(pages) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_page_worker) as executor:
+        return list(executor.map(page_fn, pages, chunksize=chunksize))
+
+def _eval_all_pairs_page(page):
+    model = _page_eval_state['model']
+    parapairs = _page_eval_state['parapairs']
+    test_data_builder = _page_eval_state['builder']
+    qry_attn_ts = []
+    qid = 'Query:'+sha1(str.encode(page)).hexdigest()
+    for i in range(len(parapairs[page]['parapairs'])):
+        p1 = parapairs[page]['parapairs'][i].split('_')[0]
+        p2 = parapairs[page]['parapairs'][i].split('_')[1]
+        qry_attn_ts.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
+    X_test, y_test = test_data_builder.build_input_data(qry_attn_ts)
+    if len(set(y_test.cpu().numpy())) < 2:
+        return None
+
+    with torch.no_grad():
+        ypred_test = model(X_test)
+    test_auc = roc_auc_score(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
+    test_f1 = calc_f1(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
+
+    cos = nn.CosineSimilarity(dim=1, eps=1e-6)
+    y_cos = cos(X_test[:, 768:768 * 2], X_test[:, 768 * 2:])
+    cos_auc = roc_auc_score(y_test, y_cos)
+    cos_f1 = calc_f1(y_test, y_cos)
+    y_euclid = torch.sqrt(torch.sum((X_test[:, 768:768 * 2] - X_test[:, 768 * 2:]) ** 2, 1)).numpy()
+    y_euclid = 1 - (y_euclid - np.min(y_euclid)) / (np.max(y_euclid) - np.min(y_euclid))
+    euclid_auc = roc_auc_score(y_test, y_euclid)
+    euclid_f1 = calc_f1(y_test, y_euclid)
+    return test_auc, test_f1, euclid_auc, euclid_f1, cos_auc, cos_f1
+
 def eval_all_pairs(parapairs_data, model_path, model_type, test_pids_file, test_pvecs_file, test_qids_file,
-                 test_qvecs_file):
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
+                 test_qvecs_file, workers=1):
+    test_paras = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
     model = CATSSimilarityModel(768, model_type)
     model.load_state_dict(torch.load(model_path))
     model.eval()
@@ -53,30 +110,13 @@ def eval_all_pairs(parapairs_data, model_path, model_type, test_pids_file, test_
             p2 = parapairs[page]['parapairs'][i].split('_')[1]
             qry_attn.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
 
-    test_data_builder = InputCATSDatasetBuilder(qry_attn, test_pids, test_pvecs, test_qids, test_qvecs)
-    for page in parapairs.keys():
-        qry_attn_ts = []
-        qid = 'Query:'+sha1(str.encode(page)).hexdigest()
-        for i in range(len(parapairs[page]['parapairs'])):
-            p1 = parapairs[page]['parapairs'][i].split('_')[0]
-            p2 = parapairs[page]['parapairs'][i].split('_')[1]
-            qry_attn_ts.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
-        X_test, y_test = test_data_builder.build_input_data(qry_attn_ts)
-        if len(set(y_test.cpu().numpy())) < 2:
+    test_data_builder = InputCATSDatasetBuilder(qry_attn, test_paras, test_queries)
+    _page_eval_state.update(model=model, parapairs=parapairs, builder=test_data_builder)
+    pages = list(parapairs.keys())
+    for page, result in zip(pages, map_pages(_eval_all_pairs_page, pages, workers)):
+        if result is None:
             continue
-
-        ypred_test = model(X_test)
-        test_auc = roc_auc_score(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
-        test_f1 = calc_f1(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
-
-        cos = nn.CosineSimilarity(dim=1, eps=1e-6)
-        y_cos = cos(X_test[:, 768:768 * 2], X_test[:, 768 * 2:])
-        cos_auc = roc_auc_score(y_test, y_cos)
-        cos_f1 = calc_f1(y_test, y_cos)
-        y_euclid = torch.sqrt(torch.sum((X_test[:, 768:768 * 2] - X_test[:, 768 * 2:]) ** 2, 1)).numpy()
-        y_euclid = 1 - (y_euclid - np.min(y_euclid)) / (np.max(y_euclid) - np.min(y_euclid))
-        euclid_auc = roc_auc_score(y_test, y_euclid)
-        euclid_f1 = calc_f1(y_test, y_euclid)
+        test_auc, test_f1, euclid_auc, euclid_f1, cos_auc, cos_f1 = result
         pagewise_all_auc[page] = test_auc
         pagewise_all_euc_auc[page] = euclid_auc
         pagewise_all_cos_auc[page] = cos_auc
@@ -86,7 +126,7 @@ def eval_all_pairs(parapairs_data, model_path, model_type, test_pids_file, test_
         cand_f1.append(test_f1)
         print(page+' Method all-pair AUC: %.5f, F1: %.5f, euclid AUC: %.5f, F1: %.5f, cosine AUC: %.5f, F1: %.5f' %
               (test_auc, test_f1, euclid_auc, euclid_f1, cos_auc, cos_f1))
-
+    _page_eval_state.clear()
     paired_ttest = ttest_rel(anchor_auc, cand_auc)
     paired_ttest_f1 = ttest_rel(anchor_f1, cand_f1)
     mean_auc = np.mean(np.array(list(pagewise_all_auc.values())))
@@ -98,57 +138,70 @@ def eval_all_pairs(parapairs_data, model_path, model_type, test_pids_file, test_
 
     return mean_auc, mean_euclid_auc, mean_cos_auc, paired_ttest, mean_f1, mean_euclid_f1, mean_cos_f1, paired_ttest_f1
 
+def _eval_cluster_page(page):
+    model = _page_eval_state['model']
+    test_data_builder = _page_eval_state['builder']
+    qry_attn_ts = _page_eval_state['qry_attn']
+    pages = _page_eval_state['pages']
+    cos = nn.CosineSimilarity(dim=1, eps=1e-6)
+    qid = 'Query:'+sha1(str.encode(page)).hexdigest()
+    if qid not in test_data_builder.query_vecs.keys():
+        return None
+    qry_attn_for_page = qry_attn_ts.page(qid)
+    X_test_page, y_test_page = test_data_builder.build_input_data(qry_attn_for_page)
+    with torch.no_grad():
+        ypred_test_page = model(X_test_page)
+    test_auc_page = roc_auc_score(y_test_page.detach().cpu().numpy(), ypred_test_page.detach().cpu().numpy())
+    test_f1_page = calc_f1(y_test_page.detach().cpu().numpy(), ypred_test_page.detach().cpu().numpy())
+
+    y_cos_page = cos(X_test_page[:, 768:768 * 2], X_test_page[:, 768 * 2:])
+    cos_auc_page = roc_auc_score(y_test_page, y_cos_page)
+    cos_f1_page = calc_f1(y_test_page, y_cos_page)
+    y_euclid_page = torch.sqrt(torch.sum((X_test_page[:, 768:768 * 2] - X_test_page[:, 768 * 2:]) ** 2, 1)).numpy()
+    y_euclid_page = 1 - (y_euclid_page - np.min(y_euclid_page)) / (np.max(y_euclid_page) - np.min(y_euclid_page))
+    euclid_auc_page = roc_auc_score(y_test_page, y_euclid_page)
+    euclid_f1_page = calc_f1(y_test_page, y_euclid_page)
+
+    paralist = sorted(pages.paras(page))
+    para_codes = pages.codes(paralist)
+    true_labels = _page_eval_state['top'].labels(para_codes)
+    true_labels_hq = _page_eval_state['hier'].labels(para_codes)
+    Xq_page, Xp_page = test_data_builder.build_page_data(qid, paralist)
+    with torch.no_grad():
+        pair_scores = model.score_page(Xq_page, Xp_page).numpy()
+    dist_mat = dist_matrix(pair_scores)
+    dist_base_mat = dist_matrix(cosine_scores(Xp_page.numpy()))
+    dist_euc_mat = dist_matrix(euclid_scores(Xp_page.numpy()), similarity=False)
+
+    g = pages.query_index[page]
+    num_clusters = [_page_eval_state['page_num_sections'][g], _page_eval_state['page_num_sections_hq'][g]]
+    cl_labels, cl_labels_hq = cut_clusters(average_linkage(dist_mat), num_clusters)
+    cl_base_labels, cl_base_labels_hq = cut_clusters(average_linkage(dist_base_mat), num_clusters)
+    cl_euclid_labels, cl_euclid_labels_hq = cut_clusters(average_linkage(dist_euc_mat), num_clusters)
+
+    return {'auc': test_auc_page, 'f1': test_f1_page, 'cos_auc': cos_auc_page, 'cos_f1': cos_f1_page,
+            'euc_auc': euclid_auc_page, 'euc_f1': euclid_f1_page,
+            'ari': adjusted_rand_score(true_labels, cl_labels),
+            'ari_hq': adjusted_rand_score(true_labels_hq, cl_labels_hq),
+            'base_ari': adjusted_rand_score(true_labels, cl_base_labels),
+            'base_ari_hq': adjusted_rand_score(true_labels_hq, cl_base_labels_hq),
+            'euc_ari': adjusted_rand_score(true_labels, cl_euclid_labels),
+            'euc_ari_hq': adjusted_rand_score(true_labels_hq, cl_euclid_labels_hq)}
+
 def eval_cluster(model_path, model_type, qry_attn_file_test, test_pids_file, test_pvecs_file, test_qids_file,
-                 test_qvecs_file, article_qrels, top_qrels, hier_qrels):
+                 test_qvecs_file, article_qrels, top_qrels, hier_qrels, workers=1):
     model = CATSSimilarityModel(768, model_type)
     model.load_state_dict(torch.load(model_path))
     model.eval()
-    qry_attn_ts = []
-    with open(qry_attn_file_test, 'r') as tsf:
-        f = True
-        for l in tsf:
-            if f:
-                f = False
-                continue
-            qry_attn_ts.append(l.split('\t'))
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
-
-    test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_pids, test_pvecs, test_qids, test_qvecs)
-    #X_test, y_test = test_data_builder.build_input_data()
+    qry_attn_ts = QryAttn.load(qry_attn_file_test)
+    test_paras = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
 
-    cos = nn.CosineSimilarity(dim=1, eps=1e-6)
+    test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_paras, test_queries)
+    #X_test, y_test = test_data_builder.build_input_data()
 
-    page_paras = read_art_qrels(article_qrels)
-    para_labels = {}
-    with open(top_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels[para] = sec
-    page_num_sections = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels[p])
-        page_num_sections[page] = len(sec)
-
-    para_labels_hq = {}
-    with open(hier_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels_hq[para] = sec
-    page_num_sections_hq = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels_hq[p])
-        page_num_sections_hq[page] = len(sec)
+    pages, top, hier, page_num_sections, page_num_sections_hq = read_cluster_qrels(article_qrels, top_qrels,
+                                                                                   hier_qrels)
 
     pagewise_ari_score = {}
     pagewise_hq_ari_score = {}
@@ -167,108 +220,31 @@ def eval_cluster(model_path, model_type, qry_attn_file_test, test_pids_file, tes
     anchor_ari_scores_hq = []
     cand_ari_scores_hq = []
 
-    for page in page_paras.keys():
-        #print('Going to cluster '+page)
-        qid = 'Query:'+sha1(str.encode(page)).hexdigest()
-        if qid not in test_data_builder.query_vecs.keys():
-            print(qid + ' not present in query vecs dict')
-        else:
-            qry_attn_for_page = [d for d in qry_attn_ts if d[0]==qid]
-            #test_data_builder_for_page = InputCATSDatasetBuilder(qry_attn_for_page, test_pids, test_pvecs, test_qids, test_qvecs)
-            X_test_page, y_test_page = test_data_builder.build_input_data(qry_attn_for_page)
-            ypred_test_page = model(X_test_page)
-            test_auc_page = roc_auc_score(y_test_page.detach().cpu().numpy(), ypred_test_page.detach().cpu().numpy())
-            test_f1_page = calc_f1(y_test_page.detach().cpu().numpy(), ypred_test_page.detach().cpu().numpy())
-
-            y_cos_page = cos(X_test_page[:, 768:768 * 2], X_test_page[:, 768 * 2:])
-            cos_auc_page = roc_auc_score(y_test_page, y_cos_page)
-            cos_f1_page = calc_f1(y_test_page, y_cos_page)
-            y_euclid_page = torch.sqrt(torch.sum((X_test_page[:, 768:768 * 2] - X_test_page[:, 768 * 2:]) ** 2, 1)).numpy()
-            y_euclid_page = 1 - (y_euclid_page - np.min(y_euclid_page)) / (np.max(y_euclid_page) - np.min(y_euclid_page))
-            euclid_auc_page = roc_auc_score(y_test_page, y_euclid_page)
-            euclid_f1_page = calc_f1(y_test_page, y_euclid_page)
-            anchor_auc.append(euclid_auc_page)
-            anchor_f1.append(euclid_f1_page)
-            cand_auc.append(test_auc_page)
-            cand_f1.append(test_f1_page)
-            cos_auc.append(cos_auc_page)
-            cos_f1.append(cos_f1_page)
-
-            paralist = page_paras[page]
-            true_labels = []
-            true_labels_hq = []
-            paralist.sort()
-            for i in range(len(paralist)):
-                true_labels.append(para_labels[paralist[i]])
-                true_labels_hq.append(para_labels_hq[paralist[i]])
-            X_page, parapairs = test_data_builder.build_cluster_data(qid, paralist)
-            pair_baseline_scores = cos(X_page[:, 768:768 * 2], X_page[:, 768 * 2:])
-            pair_euclid_scores = torch.sqrt(torch.sum((X_page[:, 768:768 * 2] - X_page[:, 768 * 2:])**2, 1)).numpy()
-            pair_scores = model(X_page)
-            pair_scores = (pair_scores - torch.min(pair_scores))/(torch.max(pair_scores) - torch.min(pair_scores))
-            pair_baseline_scores = (pair_baseline_scores - torch.min(pair_baseline_scores)) / (torch.max(pair_baseline_scores) - torch.min(pair_baseline_scores))
-            pair_euclid_scores = (pair_euclid_scores - np.min(pair_euclid_scores)) / (np.max(pair_euclid_scores) - np.min(pair_euclid_scores))
-            pair_score_dict = {}
-            pair_baseline_score_dict = {}
-            pair_euclid_score_dict = {}
-            for i in range(len(parapairs)):
-                pair_score_dict[parapairs[i]] = 1-pair_scores[i].item()
-                pair_baseline_score_dict[parapairs[i]] = 1-pair_baseline_scores[i]
-                pair_euclid_score_dict[parapairs[i]] = pair_euclid_scores[i]
-            dist_mat = []
-            dist_base_mat = []
-            dist_euc_mat = []
-            for i in range(len(paralist)):
-                r = []
-                rbase = []
-                reuc = []
-                for j in range(len(paralist)):
-                    if i == j:
-                        r.append(0.0)
-                        rbase.append(0.0)
-                        reuc.append(0.0)
-                    elif i < j:
-                        r.append(pair_score_dict[paralist[i]+ '_' + paralist[j]])
-                        rbase.append(pair_baseline_score_dict[paralist[i]+ '_' + paralist[j]])
-                        reuc.append(pair_euclid_score_dict[paralist[i] + '_' + paralist[j]])
-                    else:
-                        r.append(pair_score_dict[paralist[j] + '_' + paralist[i]])
-                        rbase.append(pair_baseline_score_dict[paralist[j] + '_' + paralist[i]])
-                        reuc.append(pair_euclid_score_dict[paralist[j] + '_' + paralist[i]])
-                dist_mat.append(r)
-                dist_base_mat.append(rbase)
-                dist_euc_mat.append(reuc)
-
-            cl = AgglomerativeClustering(n_clusters=page_num_sections[page], affinity='precomputed', linkage='average')
-            cl_labels = cl.fit_predict(dist_mat)
-            cl_base_labels = cl.fit_predict(dist_base_mat)
-            cl_euclid_labels = cl.fit_predict(dist_euc_mat)
-
-            cl_hq = AgglomerativeClustering(n_clusters=page_num_sections_hq[page], affinity='precomputed', linkage='average')
-            cl_labels_hq = cl_hq.fit_predict(dist_mat)
-            cl_base_labels_hq = cl_hq.fit_predict(dist_base_mat)
-            cl_euclid_labels_hq = cl_hq.fit_predict(dist_euc_mat)
-
-            ari_score = adjusted_rand_score(true_labels, cl_labels)
-            ari_score_hq = adjusted_rand_score(true_labels_hq, cl_labels_hq)
-            ari_base_score = adjusted_rand_score(true_labels, cl_base_labels)
-            ari_base_score_hq = adjusted_rand_score(true_labels_hq, cl_base_labels_hq)
-            ari_euc_score = adjusted_rand_score(true_labels, cl_euclid_labels)
-            ari_euc_score_hq = adjusted_rand_score(true_labels_hq, cl_euclid_labels_hq)
-            print(page+' Method bal AUC: %.5f, F1: %.5f, ARI: %.5f, Base bal AUC: %.5f, F1: %.5f, ARI: %.5f, Euclid bal AUC: %.5f, F1: %.5f, ARI: %.5f' %
-                  (test_auc_page, test_f1_page, ari_score, cos_auc_page, cos_f1_page, ari_base_score, euclid_auc_page, euclid_f1_page, ari_euc_score))
-            pagewise_ari_score[page] = ari_score
-            pagewise_base_ari_score[page] = ari_base_score
-            pagewise_euc_ari_score[page] = ari_euc_score
-            pagewise_hq_ari_score[page] = ari_score_hq
-            pagewise_base_ari_score[page] = ari_base_score
-            pagewise_hq_base_ari_score[page] = ari_base_score_hq
-            pagewise_euc_ari_score[page] = ari_euc_score
-            pagewise_hq_euc_ari_score[page] = ari_euc_score_hq
-            anchor_ari_scores.append(ari_euc_score)
-            cand_ari_scores.append(ari_score)
-            anchor_ari_scores_hq.append(ari_euc_score_hq)
-            cand_ari_scores_hq.append(ari_score_hq)
+    _page_eval_state.update(model=model, builder=test_data_builder, qry_attn=qry_attn_ts, pages=pages, top=top,
+                            hier=hier, page_num_sections=page_num_sections, page_num_sections_hq=page_num_sections_hq)
+    for page, r in zip(pages.queries, map_pages(_eval_cluster_page, pages.queries, workers)):
+        if r is None:
+            print('Query:'+sha1(str.encode(page)).hexdigest() + ' not present in query vecs dict')
+            continue
+        anchor_auc.append(r['euc_auc'])
+        anchor_f1.append(r['euc_f1'])
+        cand_auc.append(r['auc'])
+        cand_f1.append(r['f1'])
+        cos_auc.append(r['cos_auc'])
+        cos_f1.append(r['cos_f1'])
+        print(page+' Method bal AUC: %.5f, F1: %.5f, ARI: %.5f, Base bal AUC: %.5f, F1: %.5f, ARI: %.5f, Euclid bal AUC: %.5f, F1: %.5f, ARI: %.5f' %
+              (r['auc'], r['f1'], r['ari'], r['cos_auc'], r['cos_f1'], r['base_ari'], r['euc_auc'], r['euc_f1'], r['euc_ari']))
+        pagewise_ari_score[page] = r['ari']
+        pagewise_base_ari_score[page] = r['base_ari']
+        pagewise_euc_ari_score[page] = r['euc_ari']
+        pagewise_hq_ari_score[page] = r['ari_hq']
+        pagewise_hq_base_ari_score[page] = r['base_ari_hq']
+        pagewise_hq_euc_ari_score[page] = r['euc_ari_hq']
+        anchor_ari_scores.append(r['euc_ari'])
+        cand_ari_scores.append(r['ari'])
+        anchor_ari_scores_hq.append(r['euc_ari_hq'])
+        cand_ari_scores_hq.append(r['ari_hq'])
+    _page_eval_state.clear()
 
     test_auc = np.mean(np.array(cand_auc))
     test_f1 = np.mean(np.array(cand_f1))
@@ -331,6 +307,7 @@ def main():
 
     parser.add_argument('-mt', '--model_type', default="cats") #cats, scaled, abl
     parser.add_argument('-mp', '--model_path', default="/home/sk1105/sumanta/cats_deploy/model/saved_models/cats_meanall_b32_l0.00001_i3.model") #change
+    parser.add_argument('-wk', '--workers', type=int, default=1, help='Number of processes to evaluate the pages with')
 
     '''
     parser.add_argument('-dd', '--data_dir', default="/home/sk1105/sumanta/CATS_data/")
@@ -354,7 +331,7 @@ def main():
     print("===========================")
     all_auc1, all_euc_auc1, all_cos_auc1, ttest_auc1, all_fm1, all_euc_fm1, all_cos_fm1, ttest_fm1 = eval_all_pairs(dat + args.parapairs1, args.model_path, args.model_type,
                                                           dat + args.test_pids1, dat + args.test_pvecs1,
-                                                          dat + args.test_qids1, dat + args.test_qvecs1)
+                                                          dat + args.test_qids1, dat + args.test_qvecs1, args.workers)
     bal_auc1, bal_euc_auc1, bal_cos_auc1, mean_ari1, mean_euc_ari1, mean_cos_ari1, mean_ari1_hq, mean_euc_ari1_hq, \
     mean_cos_ari1_hq, ttest1, ttest1_hq, ttest_bal_auc1, bal_fm1, bal_euc_fm1, bal_cos_fm1, ttest_bal_fm1 = eval_cluster(args.model_path,
                                                                                               args.model_type,
@@ -365,12 +342,13 @@ def main():
                                                                                               dat + args.test_qvecs1,
                                                                                               dat + args.art_qrels1,
                                                                                               dat + args.top_qrels1,
-                                                                                              dat + args.hier_qrels1)
+                                                                                              dat + args.hier_qrels1,
+                                                                                              args.workers)
     print("\nPagewise benchmark Y1 test")
     print("==========================")
     all_auc2, all_euc_auc2, all_cos_auc2, ttest_auc2, all_fm2, all_euc_fm2, all_cos_fm2, ttest_fm2 = eval_all_pairs(dat + args.parapairs2, args.model_path, args.model_type,
                                                           dat + args.test_pids2, dat + args.test_pvecs2,
-                                                          dat + args.test_qids2, dat + args.test_qvecs2)
+                                                          dat + args.test_qids2, dat + args.test_qvecs2, args.workers)
     bal_auc2, bal_euc_auc2, bal_cos_auc2, mean_ari2, mean_euc_ari2, mean_cos_ari2, mean_ari2_hq, mean_euc_ari2_hq, \
     mean_cos_ari2_hq, ttest2, ttest2_hq, ttest_bal_auc2, bal_fm2, bal_euc_fm2, bal_cos_fm2, ttest_bal_fm2 = eval_cluster(args.model_path,
                                                                                               args.model_type,
@@ -381,7 +359,8 @@ def main():
                                                                                               dat + args.test_qvecs2,
                                                                                               dat + args.art_qrels2,
                                                                                               dat + args.top_qrels2,
-                                                                                              dat + args.hier_qrels2)
+                                                                                              dat + args.hier_qrels2,
+                                                                                              args.workers)
     print("\nbenchmark Y1 test")
     print("==================")
     print("AUC method all pairs: %.5f (p %.5f), balanced: %.5f (p %.5f)" % (
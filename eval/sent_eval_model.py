@@ -1,7 +1,11 @@
 from model.layers import CATS, CATS_Scaled, CATS_QueryScaler, CATS_manhattan
 from model.models import CATSSimilarityModel
 from model.sent_models import CATSSentenceModel
-from data.utils import InputCATSDatasetBuilder, read_art_qrels, InputSentenceCATSDatasetBuilder
+from data.utils import InputCATSDatasetBuilder, InputSentenceCATSDatasetBuilder
+from data.qrels import read_cluster_qrels
+from data.embedding_store import EmbeddingStore
+from data.qry_attn import QryAttn
+from eval.clustering import dist_matrix, euclid_scores, average_linkage, cut_clusters
 import torch
 torch.manual_seed(42)
 import torch.nn as nn
@@ -11,7 +15,6 @@ from numpy.random import seed
 seed(42)
 from hashlib import sha1
 from sklearn.metrics import roc_auc_score, adjusted_rand_score, f1_score
-from sklearn.cluster import AgglomerativeClustering, DBSCAN
 import argparse
 import math
 import time
@@ -28,12 +31,9 @@ def calc_f1(y_true, y_pred):
 
 def eval_all_pairs(parapairs_data, model, test_pids_file, test_pvecs_file, test_pids_para_file, test_pvecs_para_file,
                    test_qids_file, test_qvecs_file, max_seq_len):
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_pids_para = np.load(test_pids_para_file)
-    test_pvecs_para = np.load(test_pvecs_para_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
+    test_sents = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_paras = EmbeddingStore(test_pids_para_file, test_pvecs_para_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
     model.cpu()
     with open(parapairs_data, 'r') as f:
         parapairs = json.load(f)
@@ -44,8 +44,8 @@ def eval_all_pairs(parapairs_data, model, test_pids_file, test_pvecs_file, test_
             p1 = parapairs[page]['parapairs'][i].split('_')[0]
             p2 = parapairs[page]['parapairs'][i].split('_')[1]
             qry_attn.append([qid, p1, p2, int(parapairs[page]['labels'][i])])
-    test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn, test_pids, test_pvecs, test_qids, test_qvecs, max_seq_len)
-    test_data_builder_para = InputCATSDatasetBuilder(qry_attn, test_pids_para, test_pvecs_para, test_qids, test_qvecs)
+    test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn, test_sents, test_queries, max_seq_len)
+    test_data_builder_para = InputCATSDatasetBuilder(qry_attn, test_paras, test_queries)
     cand_auc = []
     cand_f1 = []
     anchor_auc = []
@@ -85,52 +85,16 @@ def eval_all_pairs(parapairs_data, model, test_pids_file, test_pvecs_file, test_
 
 def eval_cluster(qry_attn_file_test, model, test_pids_file, test_pvecs_file, test_pids_para_file, test_pvecs_para_file,
                  test_qids_file, test_qvecs_file, article_qrels, top_qrels, hier_qrels, max_seq_len):
-    qry_attn_full = []
-    with open(qry_attn_file_test, 'r') as tsf:
-        f = True
-        for l in tsf:
-            if f:
-                f = False
-                continue
-            qry_attn_full.append(l.split('\t'))
-    test_pids = np.load(test_pids_file)
-    test_pvecs = np.load(test_pvecs_file)
-    test_pids_para = np.load(test_pids_para_file)
-    test_pvecs_para = np.load(test_pvecs_para_file)
-    test_qids = np.load(test_qids_file)
-    test_qvecs = np.load(test_qvecs_file)
+    qry_attn_full = QryAttn.load(qry_attn_file_test)
+    test_sents = EmbeddingStore(test_pids_file, test_pvecs_file)
+    test_paras = EmbeddingStore(test_pids_para_file, test_pvecs_para_file)
+    test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
 
-    test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_full, test_pids, test_pvecs, test_qids, test_qvecs, max_seq_len)
-    test_data_builder_para = InputCATSDatasetBuilder(qry_attn_full, test_pids_para, test_pvecs_para, test_qids, test_qvecs)
+    test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_full, test_sents, test_queries, max_seq_len)
+    test_data_builder_para = InputCATSDatasetBuilder(qry_attn_full, test_paras, test_queries)
 
-    page_paras = read_art_qrels(article_qrels)
-    para_labels = {}
-    with open(top_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels[para] = sec
-    page_num_sections = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels[p])
-        page_num_sections[page] = len(sec)
-
-    para_labels_hq = {}
-    with open(hier_qrels, 'r') as f:
-        for l in f:
-            para = l.split(' ')[2]
-            sec = l.split(' ')[0]
-            para_labels_hq[para] = sec
-    page_num_sections_hq = {}
-    for page in page_paras.keys():
-        paras = page_paras[page]
-        sec = set()
-        for p in paras:
-            sec.add(para_labels_hq[p])
-        page_num_sections_hq[page] = len(sec)
+    pages, top, hier, page_num_sections, page_num_sections_hq = read_cluster_qrels(article_qrels, top_qrels,
+                                                                                   hier_qrels)
 
     pagewise_ari_score = {}
     pagewise_hq_ari_score = {}
@@ -145,12 +109,12 @@ def eval_cluster(qry_attn_file_test, model, test_pids_file, test_pvecs_file, tes
     anchor_ari_scores_hq = []
     cand_ari_scores_hq = []
 
-    for page in page_paras.keys():
+    for page in pages:
         qid = 'Query:'+sha1(str.encode(page)).hexdigest()
         if qid not in test_data_builder_para.query_vecs.keys():
             print(qid + ' not present in query vecs dict')
         else:
-            qry_attn_for_page = [d for d in qry_attn_full if d[0]==qid]
+            qry_attn_for_page = qry_attn_full.page(qid)
             #test_data_builder_for_page = InputCATSDatasetBuilder(qry_attn_for_page, test_pids, test_pvecs, test_qids, test_qvecs)
             X_q_page, X_p_page, y_page, _ = test_data_builder.build_input_data(qry_attn_for_page)
             ypred_test_page = model(X_q_page, X_p_page)
@@ -168,53 +132,23 @@ def eval_cluster(qry_attn_file_test, model, test_pids_file, test_pvecs_file, tes
             anchor_f1.append(euclid_f1_page)
             cand_f1.append(test_f1_page)
 
-            paralist = page_paras[page]
-            true_labels = []
-            true_labels_hq = []
-            paralist.sort()
-            for i in range(len(paralist)):
-                true_labels.append(para_labels[paralist[i]])
-                true_labels_hq.append(para_labels_hq[paralist[i]])
-
-            X_q, X_p, pairs = test_data_builder.build_cluster_data(qid, paralist)
-            pair_scores = model(X_q, X_p)
-            pair_scores = (pair_scores - torch.min(pair_scores)) / (torch.max(pair_scores) - torch.min(pair_scores))
-
-            X_page, parapairs = test_data_builder_para.build_cluster_data(qid, paralist)
-            pair_euclid_scores = torch.sqrt(torch.sum((X_page[:, 768:768 * 2] - X_page[:, 768 * 2:])**2, 1)).numpy()
-            pair_euclid_scores = (pair_euclid_scores - np.min(pair_euclid_scores)) / (np.max(pair_euclid_scores) - np.min(pair_euclid_scores))
-
-            pair_score_dict = {}
-            pair_euclid_score_dict = {}
-            for pp in parapairs:
-                pair_score_dict[pp] = 1-pair_scores[pairs.index(pp)].item()
-                pair_euclid_score_dict[pp] = pair_euclid_scores[parapairs.index(pp)]
-            dist_mat = []
-            dist_euc_mat = []
+            paralist = sorted(pages.paras(page))
+            para_codes = pages.codes(paralist)
+            true_labels = top.labels(para_codes)
+            true_labels_hq = hier.labels(para_codes)
 
-            for i in range(len(paralist)):
-                r = []
-                reuc = []
-                for j in range(len(paralist)):
-                    if i == j:
-                        r.append(0.0)
-                        reuc.append(0.0)
-                    elif i < j:
-                        r.append(pair_score_dict[paralist[i]+ '_' + paralist[j]])
-                        reuc.append(pair_euclid_score_dict[paralist[i] + '_' + paralist[j]])
-                    else:
-                        r.append(pair_score_dict[paralist[j] + '_' + paralist[i]])
-                        reuc.append(pair_euclid_score_dict[paralist[j] + '_' + paralist[i]])
-                dist_mat.append(r)
-                dist_euc_mat.append(reuc)
+            Xq_sent_page, Xp_sent_page = test_data_builder.build_page_data(qid, paralist)
+            with torch.no_grad():
+                pair_scores = model.score_page(Xq_sent_page, Xp_sent_page).numpy()
+            dist_mat = dist_matrix(pair_scores)
 
-            cl = AgglomerativeClustering(n_clusters=page_num_sections[page], affinity='precomputed', linkage='average')
-            cl_labels = cl.fit_predict(dist_mat)
-            cl_euclid_labels = cl.fit_predict(dist_euc_mat)
+            Xq_page, Xp_page = test_data_builder_para.build_page_data(qid, paralist)
+            dist_euc_mat = dist_matrix(euclid_scores(Xp_page.numpy()), similarity=False)
 
-            cl_hq = AgglomerativeClustering(n_clusters=page_num_sections_hq[page], affinity='precomputed', linkage='average')
-            cl_labels_hq = cl_hq.fit_predict(dist_mat)
-            cl_euclid_labels_hq = cl_hq.fit_predict(dist_euc_mat)
+            g = pages.query_index[page]
+            num_clusters = [page_num_sections[g], page_num_sections_hq[g]]
+            cl_labels, cl_labels_hq = cut_clusters(average_linkage(dist_mat), num_clusters)
+            cl_euclid_labels, cl_euclid_labels_hq = cut_clusters(average_linkage(dist_euc_mat), num_clusters)
 
             ari_score = adjusted_rand_score(true_labels, cl_labels)
             ari_score_hq = adjusted_rand_score(true_labels_hq, cl_labels_hq)
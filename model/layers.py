@@ -2,6 +2,23 @@ import torch
 torch.manual_seed(42)
 import torch.nn as nn
 
+def cats_page_scores(LL1, LL2, LL3, Xq, Xp):
+    '''
+    Factorized CATS head shared by CATS.score_page and CATS_Attention.score_page: scores all pairs of the paras Xp
+    (m X vec size) or (n X m X vec size) under the context Xq (vec size) or (n X vec size), pairs in the order of
+    combinations(range(m), 2)
+    '''
+    m = Xp.shape[-2]
+    i, j = torch.triu_indices(m, m, 1, device=Xp.device)
+    w = LL3.weight.reshape(5, -1)
+    zp = torch.relu(LL2(LL1(Xp)))
+    zql = torch.relu(LL2(LL1(Xq))).unsqueeze(-2)
+    zdq = torch.abs(zp - zql)
+    s1 = torch.matmul(zp, w[0]) + torch.matmul(zdq, w[3])
+    s2 = torch.matmul(zp, w[1]) + torch.matmul(zdq, w[4])
+    sd = torch.matmul(torch.abs(zp[..., i, :] - zp[..., j, :]), w[2])
+    return torch.relu(s1[..., i] + s2[..., j] + sd + LL3.bias)
+
 class CATS(nn.Module): # CATS
     def __init__(self, emb_size):
         super(CATS, self).__init__()
@@ -33,6 +50,20 @@ class CATS(nn.Module): # CATS
         o = o.reshape(-1)
         return o
 
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page, projecting the query and each para only once. LL3 is split into one weight
+        block per input of the concatenated feature vector so that the per para terms are computed m times instead
+        of mC2 times. Gives the same scores as forward on the rows of InputCATSDatasetBuilder.build_cluster_data.
+        A batch of n pages can be scored in one call by adding a leading dimension to both inputs.
+
+        :param Xq: context vec of shape (vec size) or (n X vec size)
+        :param Xp: para vecs of shape (m X vec size) or (n X m X vec size), pairs are taken in the order of
+        combinations(range(m), 2)
+        :return s: Pairwise CATS scores of shape (mC2) or (n X mC2)
+        '''
+        return cats_page_scores(self.LL1, self.LL2, self.LL3, Xq, Xp)
+
     def num_flat_features(self, X):
         size = X.size()[1:]  # all dimensions except the batch dimension
         num_features = 1
@@ -76,6 +107,25 @@ class CATS_Ablation(nn.Module):
         o = o.reshape(-1)
         return o
 
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page, projecting each para only once. See CATS.score_page.
+
+        :param Xq: context vec of shape (vec size) or (n X vec size), unused by the ablation model
+        :param Xp: para vecs of shape (m X vec size) or (n X m X vec size), pairs are taken in the order of
+        combinations(range(m), 2)
+        :return s: Pairwise scores of shape (mC2) or (n X mC2)
+        '''
+        m = Xp.shape[-2]
+        i, j = torch.triu_indices(m, m, 1, device=Xp.device)
+        w = self.LL3.weight.reshape(3, self.emb_size)
+        zp = torch.relu(self.LL2(self.LL1(Xp)))
+        s1 = torch.matmul(zp, w[0])
+        s2 = torch.matmul(zp, w[1])
+        sd = torch.matmul(torch.abs(zp[..., i, :] - zp[..., j, :]), w[2])
+        o = torch.relu(s1[..., i] + s2[..., j] + sd + self.LL3.bias)
+        return o
+
     def num_flat_features(self, X):
         size = X.size()[1:]  # all dimensions except the batch dimension
         num_features = 1
@@ -87,21 +137,120 @@ class CATS_Ablation(nn.Module):
         y_pred = self.forward(X_test)
         return y_pred
 
+def masked_softmax_pool(S, valid, sents):
+    '''
+    Attention pooling over padded sentence slots: softmax of the scores S over the valid slots only, the padded slots
+    get -inf and so zero weight, then the weighted sum of the sentence vecs. torch.softmax subtracts the row max, so
+    large scores do not overflow. Paras without any valid slot pool to the zero padding instead of NaN.
+
+    :param S: attention scores of shape (b X max seq len)
+    :param valid: valid bits of shape (b X max seq len)
+    :param sents: sentence vecs of shape (b X vec size X max seq len)
+    :return: pooled vecs of shape (b X vec size)
+    '''
+    pad = (valid == 0) & (valid != 0).any(1, keepdim=True)
+    beta = torch.softmax(S.masked_fill(pad, float('-inf')), 1)
+    return torch.matmul(sents, beta.unsqueeze(2)).squeeze(2)
+
+def packed_attention_pool(Xq, sents, starts, lengths, Wa, va):
+    '''
+    Query attention pooling of ragged paras given as one flat sentence matrix, the packed counterpart of the padded
+    (b X vec size + 1 X max seq len) input of the sentence attention models. The attention scores of all sentences
+    are computed in one matmul and the softmax and the weighted sum run per para with segment (scatter) ops, so no
+    work is spent on padding. Paras without sentences pool to zero vecs.
+
+    :param Xq: context vecs of shape (b X vec size)
+    :param sents: flat sentence vecs of shape (N X vec size)
+    :param starts: long tensor of shape (b), the sentences of para k are sents[starts[k]:starts[k] + lengths[k]]
+    :param lengths: long tensor of shape (b)
+    :param Wa: attention weights of shape (2*vec size X n), the first vec size rows apply to the query
+    :param va: attention vec of shape (n X 1)
+    :return: pooled para vecs of shape (b X vec size)
+    '''
+    b, emb_size = Xq.shape
+    seg = torch.repeat_interleave(torch.arange(b, device=Xq.device), lengths)
+    offsets = torch.cumsum(lengths, 0) - lengths
+    rows = torch.repeat_interleave(starts - offsets, lengths) + torch.arange(seg.shape[0], device=Xq.device)
+    S = sents.index_select(0, rows)
+    scores = torch.mm(torch.tanh(torch.mm(Xq, Wa[:emb_size]).index_select(0, seg) + torch.mm(S, Wa[emb_size:])),
+                      va).reshape(-1)
+    smax = torch.full((b,), float('-inf'), dtype=scores.dtype, device=scores.device)
+    # the softmax does not depend on the shift, so the segment max needs no gradient
+    smax = smax.scatter_reduce(0, seg, scores.detach(), reduce='amax', include_self=True)
+    e = torch.exp(scores - smax.index_select(0, seg))
+    denom = torch.zeros(b, dtype=e.dtype, device=e.device).index_add(0, seg, e)
+    beta = e / denom.index_select(0, seg)
+    return torch.zeros(b, emb_size, dtype=S.dtype, device=S.device).index_add(0, seg, beta.unsqueeze(1) * S)
+
+class QueryAttentionPooler(nn.Module):
+    '''
+    Query attention pooling shared by the sentence models: the sentences s of a para are weighted by a softmax over
+    va . tanh(Wa . [query; s]) of its valid sentences and summed. pool_pairs and pool_pairs_packed pool both paras of
+    a pair in one call by stacking them along the batch dimension.
+    '''
+    def __init__(self, emb_size, n):
+        super(QueryAttentionPooler, self).__init__()
+        self.emb_size = emb_size
+        self.n = n
+        self.Wa = nn.Parameter(torch.randn(2 * emb_size, n))
+        self.va = nn.Parameter(torch.randn(n, 1))
+        self.tanh = nn.Tanh()
+
+    def forward(self, Xq, Xp):
+        '''
+
+        :param Xq: context vec of shape (b X vec size)
+        :param Xp: para sent vecs of shape (b X vec size + 1 X max seq len), the last row holds the valid bits
+        :return: pooled para vecs of shape (b X vec size)
+        '''
+        b, _, seq = Xp.shape
+        valid = Xp[:, -1, :]
+        sents = Xp[:, :self.emb_size, :]
+        # [query; s] . Wa is split so the query part is computed once per row instead of once per sentence
+        S = torch.matmul(self.tanh(torch.matmul(sents.transpose(1, 2), self.Wa[self.emb_size:]) +
+                                   torch.mm(Xq, self.Wa[:self.emb_size]).unsqueeze(1)), self.va).reshape(b, seq)
+        return masked_softmax_pool(S, valid, sents)
+
+    def pool_pairs(self, Xq, Xp):
+        '''
+
+        :param Xq: context vec of shape (b X vec size)
+        :param Xp: para sent vecs of shape (b X 2*vec size + 2 X max seq len)
+        :return: pooled para1 vecs and para2 vecs, each of shape (b X vec size)
+        '''
+        b, _, seq = Xp.shape
+        Xp = Xp.reshape(b, 2, self.emb_size + 1, seq).transpose(0, 1).reshape(2 * b, self.emb_size + 1, seq)
+        pooled = self.forward(torch.cat((Xq, Xq)), Xp)
+        return pooled[:b], pooled[b:]
+
+    def pool_pairs_packed(self, Xq, sents, starts1, lengths1, starts2, lengths2):
+        '''
+        Same as pool_pairs for packed input, see packed_attention_pool
+        '''
+        b = Xq.shape[0]
+        pooled = packed_attention_pool(torch.cat((Xq, Xq)), sents, torch.cat((starts1, starts2)),
+                                       torch.cat((lengths1, lengths2)), self.Wa, self.va)
+        return pooled[:b], pooled[b:]
+
+def remap_pooler_keys(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    '''
+    load_state_dict pre-hook of the sentence models: state dicts saved before the attention pooling moved into
+    QueryAttentionPooler have Wa and va on the model itself instead of under pooler
+    '''
+    for name in ('Wa', 'va'):
+        if prefix + name in state_dict:
+            state_dict[prefix + 'pooler.' + name] = state_dict.pop(prefix + name)
+
 class Sent_Attention(nn.Module):
     def __init__(self, emb_size, n):
         super(Sent_Attention, self).__init__()
-        if torch.cuda.is_available():
-            device = torch.device('cuda:0')
-        else:
-            device = torch.device('cpu')
         self.emb_size = emb_size
         self.n = n
         self.LL1 = nn.Linear(emb_size, emb_size)
         self.LL2 = nn.Linear(emb_size, emb_size)
         self.LL3 = nn.Linear(5 * emb_size, 1)
-        self.Wa = nn.Parameter(torch.tensor(torch.randn(2*emb_size, self.n), requires_grad=True).to(device))
-        self.va = nn.Parameter(torch.tensor(torch.randn(self.n, 1), requires_grad=True).to(device))
-        self.tanh = nn.Tanh()
+        self.pooler = QueryAttentionPooler(emb_size, n)
+        self._register_load_state_dict_pre_hook(remap_pooler_keys)
         self.cos = nn.CosineSimilarity()
 
     def forward(self, Xq, Xp):
@@ -111,29 +260,44 @@ class Sent_Attention(nn.Module):
         :param Xp: para sent vecs of shape (m X 2*vec size + 2 X max seq len)
         :return: Pairwise CATS scores of shape (mC2 X 1)
         '''
-        b = Xq.shape[0]
-        seq = Xp.shape[2]
         self.Xq = Xq
-        self.Xp1 = Xp[:, :self.emb_size + 1, :]
-        self.Xp2 = Xp[:, self.emb_size + 1:, :]
-        self.Xp1valid = self.Xp1[:, -1, :]
-        self.Xp2valid = self.Xp2[:, -1, :]
-        self.Xp1 = self.Xp1[:, :self.emb_size, :]
-        self.Xp2 = self.Xp2[:, :self.emb_size, :]
-
-        self.Xqp1 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp1), 1)
-        self.S1 = torch.mul(self.Xp1valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp1.permute(0,2,1).reshape(-1, 2*self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta1 = torch.exp(self.S1) / torch.sum(torch.exp(self.S1), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp1dash = torch.sum(torch.mul(self.beta1.reshape(b, 1, seq), self.Xp1), 2)
-
-        self.Xqp2 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp2), 1)
-        self.S2 = torch.mul(self.Xp2valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp2.permute(0, 2, 1).reshape(-1, 2 * self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta2 = torch.exp(self.S2) / torch.sum(torch.exp(self.S2), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp2dash = torch.sum(torch.mul(self.beta2.reshape(b, 1, seq), self.Xp2), 2)
-
-        o = self.cos(self.Xp1dash, self.Xp2dash)
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs(Xq, Xp)
+        return self.score_pooled(self.Xq, self.Xp1dash, self.Xp2dash)
+
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page, pooling each para once under the query instead of once per pair it is
+        part of. Gives the same scores as forward on the pairs of InputSentenceCATSDatasetBuilder.build_cluster_data.
+
+        :param Xq: context vec of shape (vec size)
+        :param Xp: para sent vecs of shape (m X vec size + 1 X max seq len) as returned by
+        InputSentenceCATSDatasetBuilder.build_page_data
+        :return: Pairwise scores of shape (mC2), pairs in the order of combinations(range(m), 2)
+        '''
+        pooled = self.pooler(Xq.reshape(1, -1).expand(Xp.shape[0], -1), Xp)
+        m = pooled.shape[0]
+        i, j = torch.triu_indices(m, m, 1, device=pooled.device)
+        return self.cos(pooled[i], pooled[j])
+
+    def forward_packed(self, Xq, sents, starts1, lengths1, starts2, lengths2):
+        '''
+        Same as forward for packed input, see packed_attention_pool
+
+        :param Xq: context vec of shape (b X vec size)
+        :param sents: flat sentence vecs of shape (N X vec size)
+        :param starts1, lengths1: long tensors of shape (b), sentence spans of para1 in sents
+        :param starts2, lengths2: long tensors of shape (b), sentence spans of para2 in sents
+        :return: Pairwise scores of shape (b)
+        '''
+        self.Xq = Xq
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs_packed(Xq, sents, starts1, lengths1, starts2, lengths2)
+        return self.score_pooled(Xq, self.Xp1dash, self.Xp2dash)
+
+    def score_pooled(self, Xq, Xp1dash, Xp2dash):
+        '''
+        Pair scores from the attention pooled para vecs Xp1dash, Xp2dash of shape (b X vec size)
+        '''
+        o = self.cos(Xp1dash, Xp2dash)
         o = o.reshape(-1)
         return o
 
@@ -152,18 +316,13 @@ class Sent_Attention(nn.Module):
 class CATS_Attention(nn.Module):
     def __init__(self, emb_size, n):
         super(CATS_Attention, self).__init__()
-        if torch.cuda.is_available():
-            device = torch.device('cuda:0')
-        else:
-            device = torch.device('cpu')
         self.emb_size = emb_size
         self.n = n
         self.LL1 = nn.Linear(emb_size, emb_size)
         self.LL2 = nn.Linear(emb_size, emb_size)
         self.LL3 = nn.Linear(5 * emb_size, 1)
-        self.Wa = nn.Parameter(torch.tensor(torch.randn(2 * emb_size, self.n), requires_grad=True).to(device))
-        self.va = nn.Parameter(torch.tensor(torch.randn(self.n, 1), requires_grad=True).to(device))
-        self.tanh = nn.Tanh()
+        self.pooler = QueryAttentionPooler(emb_size, n)
+        self._register_load_state_dict_pre_hook(remap_pooler_keys)
 
     def forward(self, Xq, Xp):
         '''
@@ -172,34 +331,47 @@ class CATS_Attention(nn.Module):
         :param Xp: para sent vecs of shape (m X 2*vec size + 2 X max seq len)
         :return: Pairwise CATS scores of shape (mC2 X 1)
         '''
-        b = Xq.shape[0]
-        seq = Xp.shape[2]
         self.Xq = Xq
-        self.Xp1 = Xp[:, :self.emb_size + 1, :]
-        self.Xp2 = Xp[:, self.emb_size + 1:, :]
-        self.Xp1valid = self.Xp1[:, -1, :]
-        self.Xp2valid = self.Xp2[:, -1, :]
-        self.Xp1 = self.Xp1[:, :self.emb_size, :]
-        self.Xp2 = self.Xp2[:, :self.emb_size, :]
-
-        self.Xqp1 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp1), 1)
-        self.S1 = torch.mul(self.Xp1valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp1.permute(0, 2, 1).reshape(-1, 2 * self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta1 = torch.exp(self.S1) / torch.sum(torch.exp(self.S1), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp1dash = torch.sum(torch.mul(self.beta1.reshape(b, 1, seq), self.Xp1), 2)
-
-        self.Xqp2 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp2), 1)
-        self.S2 = torch.mul(self.Xp2valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp2.permute(0, 2, 1).reshape(-1, 2 * self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta2 = torch.exp(self.S2) / torch.sum(torch.exp(self.S2), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp2dash = torch.sum(torch.mul(self.beta2.reshape(b, 1, seq), self.Xp2), 2)
-
-        self.z1 = torch.abs(self.Xp1dash - self.Xq)
-        self.z2 = torch.abs(self.Xp2dash - self.Xq)
-        self.zdiff = torch.abs(self.Xp1dash - self.Xp2dash)
-        self.zp1 = torch.relu(self.LL2(self.LL1(self.Xp1dash)))
-        self.zp2 = torch.relu(self.LL2(self.LL1(self.Xp2dash)))
-        self.zql = torch.relu(self.LL2(self.LL1(self.Xq)))
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs(Xq, Xp)
+        return self.score_pooled(self.Xq, self.Xp1dash, self.Xp2dash)
+
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page, pooling each para once under the query instead of once per pair it is
+        part of. Gives the same scores as forward on the pairs of InputSentenceCATSDatasetBuilder.build_cluster_data.
+
+        :param Xq: context vec of shape (vec size)
+        :param Xp: para sent vecs of shape (m X vec size + 1 X max seq len) as returned by
+        InputSentenceCATSDatasetBuilder.build_page_data
+        :return: Pairwise scores of shape (mC2), pairs in the order of combinations(range(m), 2)
+        '''
+        pooled = self.pooler(Xq.reshape(1, -1).expand(Xp.shape[0], -1), Xp)
+        return cats_page_scores(self.LL1, self.LL2, self.LL3, Xq, pooled)
+
+    def forward_packed(self, Xq, sents, starts1, lengths1, starts2, lengths2):
+        '''
+        Same as forward for packed input, see packed_attention_pool
+
+        :param Xq: context vec of shape (b X vec size)
+        :param sents: flat sentence vecs of shape (N X vec size)
+        :param starts1, lengths1: long tensors of shape (b), sentence spans of para1 in sents
+        :param starts2, lengths2: long tensors of shape (b), sentence spans of para2 in sents
+        :return: Pairwise scores of shape (b)
+        '''
+        self.Xq = Xq
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs_packed(Xq, sents, starts1, lengths1, starts2, lengths2)
+        return self.score_pooled(Xq, self.Xp1dash, self.Xp2dash)
+
+    def score_pooled(self, Xq, Xp1dash, Xp2dash):
+        '''
+        CATS scores from the attention pooled para vecs Xp1dash, Xp2dash of shape (b X vec size)
+        '''
+        self.z1 = torch.abs(Xp1dash - Xq)
+        self.z2 = torch.abs(Xp2dash - Xq)
+        self.zdiff = torch.abs(Xp1dash - Xp2dash)
+        self.zp1 = torch.relu(self.LL2(self.LL1(Xp1dash)))
+        self.zp2 = torch.relu(self.LL2(self.LL1(Xp2dash)))
+        self.zql = torch.relu(self.LL2(self.LL1(Xq)))
         self.zd = torch.abs(self.zp1 - self.zp2)
         self.zdqp1 = torch.abs(self.zp1 - self.zql)
         self.zdqp2 = torch.abs(self.zp2 - self.zql)
@@ -223,17 +395,12 @@ class CATS_Attention(nn.Module):
 class Sent_FixedCATS_Attention(nn.Module):
     def __init__(self, emb_size, n, cats_model):
         super(Sent_FixedCATS_Attention, self).__init__()
-        if torch.cuda.is_available():
-            device = torch.device('cuda:0')
-        else:
-            device = torch.device('cpu')
         self.emb_size = emb_size
         self.n = n
         self.cats = cats_model
         self.cats.eval()
-        self.Wa = nn.Parameter(torch.tensor(torch.randn(2*emb_size, self.n), requires_grad=True).to(device))
-        self.va = nn.Parameter(torch.tensor(torch.randn(self.n, 1), requires_grad=True).to(device))
-        self.tanh = nn.Tanh()
+        self.pooler = QueryAttentionPooler(emb_size, n)
+        self._register_load_state_dict_pre_hook(remap_pooler_keys)
         self.cos = nn.CosineSimilarity()
 
     def forward(self, Xq, Xp):
@@ -243,30 +410,43 @@ class Sent_FixedCATS_Attention(nn.Module):
         :param Xp: para sent vecs of shape (m X 2*vec size + 2 X max seq len)
         :return: Pairwise CATS scores of shape (mC2 X 1)
         '''
-        b = Xq.shape[0]
-        seq = Xp.shape[2]
         self.Xq = Xq
         self.origXq = Xq
-        self.Xp1 = Xp[:, :self.emb_size + 1, :]
-        self.Xp2 = Xp[:, self.emb_size + 1:, :]
-        self.Xp1valid = self.Xp1[:, -1, :]
-        self.Xp2valid = self.Xp2[:, -1, :]
-        self.Xp1 = self.Xp1[:, :self.emb_size, :]
-        self.Xp2 = self.Xp2[:, :self.emb_size, :]
-
-        self.Xqp1 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp1), 1)
-        self.S1 = torch.mul(self.Xp1valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp1.permute(0,2,1).reshape(-1, 2*self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta1 = torch.exp(self.S1) / torch.sum(torch.exp(self.S1), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp1dash = torch.sum(torch.mul(self.beta1.reshape(b, 1, seq), self.Xp1), 2)
-
-        self.Xqp2 = torch.cat((self.Xq.reshape(b, self.emb_size, 1).expand(-1, -1, seq), self.Xp2), 1)
-        self.S2 = torch.mul(self.Xp2valid, torch.mm(self.tanh(
-            torch.mm(self.Xqp2.permute(0, 2, 1).reshape(-1, 2 * self.emb_size), self.Wa)), self.va).reshape(b, seq))
-        self.beta2 = torch.exp(self.S2) / torch.sum(torch.exp(self.S2), 1).unsqueeze(1).repeat(1, seq)
-        self.Xp2dash = torch.sum(torch.mul(self.beta2.reshape(b, 1, seq), self.Xp2), 2)
-        X = torch.cat((self.origXq, self.Xp1dash, self.Xp2dash), 1)
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs(Xq, Xp)
+        return self.score_pooled(self.origXq, self.Xp1dash, self.Xp2dash)
+
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page, pooling each para once under the query instead of once per pair it is
+        part of. Gives the same scores as forward on the pairs of InputSentenceCATSDatasetBuilder.build_cluster_data.
+
+        :param Xq: context vec of shape (vec size)
+        :param Xp: para sent vecs of shape (m X vec size + 1 X max seq len) as returned by
+        InputSentenceCATSDatasetBuilder.build_page_data
+        :return: Pairwise scores of shape (mC2), pairs in the order of combinations(range(m), 2)
+        '''
+        pooled = self.pooler(Xq.reshape(1, -1).expand(Xp.shape[0], -1), Xp)
+        return self.cats.score_page(Xq, pooled)
+
+    def forward_packed(self, Xq, sents, starts1, lengths1, starts2, lengths2):
+        '''
+        Same as forward for packed input, see packed_attention_pool
 
+        :param Xq: context vec of shape (b X vec size)
+        :param sents: flat sentence vecs of shape (N X vec size)
+        :param starts1, lengths1: long tensors of shape (b), sentence spans of para1 in sents
+        :param starts2, lengths2: long tensors of shape (b), sentence spans of para2 in sents
+        :return: Pairwise scores of shape (b)
+        '''
+        self.Xq = Xq
+        self.Xp1dash, self.Xp2dash = self.pooler.pool_pairs_packed(Xq, sents, starts1, lengths1, starts2, lengths2)
+        return self.score_pooled(Xq, self.Xp1dash, self.Xp2dash)
+
+    def score_pooled(self, Xq, Xp1dash, Xp2dash):
+        '''
+        Scores of the fixed CATS model on the attention pooled para vecs Xp1dash, Xp2dash of shape (b X vec size)
+        '''
+        X = torch.cat((Xq, Xp1dash, Xp2dash), 1)
         o = self.cats(X)
         o = o.reshape(-1)
         return o
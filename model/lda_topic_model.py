@@ -1,10 +1,10 @@
-from gensim import corpora
-from gensim.models import ldamodel
-from nltk.corpus import stopwords
 from collections import defaultdict
 import argparse
 
 def train_lda_tm(train_ptext_dict, num_topics, update, passes, token_dict_out, model_out_file):
+    from gensim import corpora
+    from gensim.models import ldamodel
+    from nltk.corpus import stopwords
     stops = stopwords.words('english')
     paraids = list(train_ptext_dict.keys())
     raw_docs = [train_ptext_dict[k] for k in paraids]
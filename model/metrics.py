@@ -0,0 +1,59 @@
+import torch
+
+def roc_auc(y_true, y_score):
+    '''
+    ROC AUC of binary labels computed with torch ops on the device of the inputs, so no host sync is needed until the
+    result is read. Tied scores get their average rank, which gives the same value as sklearn's roc_auc_score. Returns
+    nan if y_true has only one class.
+
+    :param y_true: tensor of shape (b) with labels 0 or 1
+    :param y_score: tensor of shape (b) of predicted scores
+    :return: 0-dim float tensor
+    '''
+    y_true = y_true.reshape(-1) > 0
+    y_score = y_score.reshape(-1).double()
+    sorted_score, order = torch.sort(y_score)
+    _, counts = torch.unique_consecutive(sorted_score, return_counts=True)
+    # 1 based rank of each distinct score, averaged over its ties
+    group_ranks = torch.cumsum(counts, 0) - (counts - 1) / 2
+    ranks = torch.empty_like(y_score)
+    ranks[order] = torch.repeat_interleave(group_ranks.double(), counts)
+    n_pos = y_true.sum().double()
+    n_neg = y_true.shape[0] - n_pos
+    return (ranks[y_true].sum() - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+class StreamingMetrics:
+    '''
+    Accumulates the loss and predictions of the training batches without leaving the device. compute() returns the
+    mean loss and the roc_auc over all the batches since the last reset and is the only point where the device is
+    synced, so the training loop only pays for it once every log interval instead of every batch.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = None
+        self.count = 0
+        self.preds = []
+        self.labels = []
+
+    def __len__(self):
+        return self.count
+
+    def update(self, loss, ypred, y):
+        '''
+        Adds one batch, loss is the mean loss of the batch
+        '''
+        b = y.shape[0]
+        loss = loss.detach() * b
+        self.loss_sum = loss if self.loss_sum is None else self.loss_sum + loss
+        self.count += b
+        self.preds.append(ypred.detach().reshape(-1))
+        self.labels.append(y.detach().reshape(-1))
+
+    def compute(self):
+        '''
+        Returns (mean loss, auc) as floats
+        '''
+        auc = roc_auc(torch.cat(self.labels), torch.cat(self.preds))
+        return (self.loss_sum / self.count).item(), auc.item()
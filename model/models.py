@@ -1,5 +1,9 @@
 from model.layers import CATS, CATS_Scaled, CATS_QueryScaler, CATS_manhattan, CATS_Ablation
-from data.utils import InputCATSDatasetBuilder
+from data.utils import InputCATSDatasetBuilder, CATSPairDataset, PairStream, pair_loader
+from data.embedding_store import EmbeddingStore
+from data.cache import FeatureCache
+from data.qry_attn import QryAttn
+from model.metrics import roc_auc, StreamingMetrics
 import torch
 torch.manual_seed(42)
 import torch.nn as nn
@@ -7,14 +11,25 @@ import torch.optim as optim
 import numpy as np
 from numpy.random import seed
 seed(42)
-import tensorflow as tf
-import pickle
 from sklearn.metrics import roc_auc_score
 import argparse
-import math
 import time
 import os.path
 
+def set_threads(num_threads=0, interop_threads=0):
+    '''
+    Sizes the intra-op and inter-op thread pools torch uses on the CPU, 0 keeps the torch default. The inter-op pool
+    can only be sized before torch runs its first inter-op parallel work, later calls keep the current size.
+    '''
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if interop_threads > 0 and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print('Inter-op threads already in use, keeping ' + str(torch.get_num_interop_threads()))
+    print('Using %d intra-op and %d inter-op threads' % (torch.get_num_threads(), torch.get_num_interop_threads()))
+
 class SimilarityClusteringModel(nn.Module):
     def __init__(self, emb_size, m):
         super(SimilarityClusteringModel, self).__init__()
@@ -23,28 +38,31 @@ class SimilarityClusteringModel(nn.Module):
 
     '''
     X is a 3D tensor of shape (n X mC2 X 3*v) where n = num of samples, m = num of paras for each query
-    and v = emb vec length
+    and v = emb vec length, as built by InputClusterDatasetBuilder.build_input_data
+    Returns the similarity matrices of shape (n X m X m), the pair scores of shape (n X mC2) are kept in
+    self.pair_score_matrix
     '''
     def forward(self, X):
-        self.pair_score_matrix = self.cats(X)
-        tf.sim_matrix = tf.map_fn(self.arrange_simscore_in_sim_matrix, self.pair_score_matrix)
-        '''
-        TODO
-        '''
+        n = X.shape[0]
+        self.pair_score_matrix = self.cats(X.reshape(-1, X.shape[2])).reshape(n, -1)
+        return self.arrange_simscore_in_sim_matrix(self.pair_score_matrix)
+
+    '''
+    Same as forward but takes the compact page input of InputClusterDatasetBuilder.build_page_data, Xq of shape
+    (n X v) and Xp of shape (n X m X v), and scores the pairs with CATS.score_page
+    '''
+    def score_pages(self, Xq, Xp):
+        self.pair_score_matrix = self.cats.score_page(Xq, Xp)
+        return self.arrange_simscore_in_sim_matrix(self.pair_score_matrix)
 
     def arrange_simscore_in_sim_matrix(self, s):
-        assert self.m * (self.m - 1) / 2 == len(s)
-        sim_matrix = np.zeros((self.m, self.m))
-        n = 0
-        for i in range(self.m):
-            for j in range(self.m):
-                if i==j:
-                    sim_matrix[i][j] = 1.0
-                elif i<j:
-                    sim_matrix[i][j] = s[n]
-                    n += 1
-                else:
-                    sim_matrix[i][j] = sim_matrix[j][i]
+        assert self.m * (self.m - 1) // 2 == s.shape[-1]
+        i, j = torch.triu_indices(self.m, self.m, 1, device=s.device)
+        d = torch.arange(self.m, device=s.device)
+        sim_matrix = s.new_zeros(s.shape[:-1] + (self.m, self.m))
+        sim_matrix[..., i, j] = s
+        sim_matrix[..., j, i] = s
+        sim_matrix[..., d, d] = 1.0
         return sim_matrix
 
 class CATSSimilarityModel(nn.Module):
@@ -65,70 +83,78 @@ class CATSSimilarityModel(nn.Module):
         self.pair_scores = self.cats(X)
         return self.pair_scores
 
+    def score_page(self, Xq, Xp):
+        '''
+        Xq is the context vec of shape (v) and Xp the para vecs of a page of shape (m X v), or (n X v) and
+        (n X m X v) for a batch of n pages
+        Returns the scores of all mC2 para pairs in the order of combinations(range(m), 2)
+        '''
+        if hasattr(self.cats, 'score_page'):
+            return self.cats.score_page(Xq, Xp)
+        m = Xp.shape[-2]
+        i, j = torch.triu_indices(m, m, 1, device=Xp.device)
+        X = torch.cat((Xq.unsqueeze(-2).expand(Xp.shape[:-2] + (i.shape[0], Xq.shape[-1])), Xp[..., i, :],
+                       Xp[..., j, :]), -1)
+        return self.cats(X.reshape(-1, X.shape[-1])).reshape(X.shape[:-1])
+
 def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pids_file, train_pvecs_file,
               test_pvecs_file, train_qids_file, test_qids_file, train_qvecs_file, test_qvecs_file, use_cache,
-              lrate, batch, epochs, save, cats_type):
-    if not use_cache:
-        qry_attn_tr = []
-        qry_attn_ts = []
-        with open(qry_attn_file_train, 'r') as trf:
-            f = True
-            for l in trf:
-                if f:
-                    f = False
-                    continue
-                qry_attn_tr.append(l.split('\t'))
-        with open(qry_attn_file_test, 'r') as tsf:
-            f = True
-            for l in tsf:
-                if f:
-                    f = False
-                    continue
-                qry_attn_ts.append(l.split('\t'))
-        train_pids = np.load(train_pids_file)
-        train_pvecs = np.load(train_pvecs_file)
-        train_qids = np.load(train_qids_file)
-        train_qvecs = np.load(train_qvecs_file)
+              lrate, batch, epochs, save, cats_type, num_workers=0, stream=False,
+              log_interval=100, accum_steps=1, threads=0, interop_threads=0,
+              vec_dtype='float32'):
+    set_threads(threads, interop_threads)
+    val_split_ratio = 0.1
+    if not stream:
+        cache = FeatureCache('cache', [qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pids_file,
+                                       train_pvecs_file, test_pvecs_file, train_qids_file, test_qids_file,
+                                       train_qvecs_file, test_qvecs_file], val_split_ratio, vec_dtype)
+    if stream:
+        # pairs stay row numbers into the memory mapped vecs files, batches are read while training
+        train_paras = EmbeddingStore(train_pids_file, train_pvecs_file)
+        test_paras = train_paras if train_pids_file == test_pids_file else EmbeddingStore(test_pids_file,
+                                                                                          test_pvecs_file)
+        train_data = PairStream.from_qry_attn(QryAttn.load(qry_attn_file_train),
+                                              EmbeddingStore(train_qids_file, train_qvecs_file), train_paras, batch)
+        test_data = PairStream.from_qry_attn(QryAttn.load(qry_attn_file_test),
+                                             EmbeddingStore(test_qids_file, test_qvecs_file), test_paras, batch)
+        val_sample_size = int(len(train_data) * val_split_ratio)
+        val_data = train_data.subset(slice(None, val_sample_size))
+        train_data = train_data.subset(slice(val_sample_size, None))
+    elif use_cache and 'test' in cache:
+        print('Loading data from ' + cache.path)
+        train_data = CATSPairDataset.load(cache, 'train')
+        val_data = CATSPairDataset.load(cache, 'val')
+        test_data = CATSPairDataset.load(cache, 'test')
+    else:
+        qry_attn_tr = QryAttn.load(qry_attn_file_train)
+        qry_attn_ts = QryAttn.load(qry_attn_file_test)
+        train_paras = EmbeddingStore(train_pids_file, train_pvecs_file)
+        train_queries = EmbeddingStore(train_qids_file, train_qvecs_file)
         if train_pids_file == test_pids_file:
-            test_pids = train_pids
-            test_pvecs = train_pvecs
+            test_paras = train_paras
         else:
-            test_pids = np.load(test_pids_file)
-            test_pvecs = np.load(test_pvecs_file)
-        test_qids = np.load(test_qids_file)
-        test_qvecs = np.load(test_qvecs_file)
+            test_paras = EmbeddingStore(test_pids_file, test_pvecs_file)
+        test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
 
         print('Building train data')
-        train_data_builder = InputCATSDatasetBuilder(qry_attn_tr, train_pids, train_pvecs, train_qids, train_qvecs)
-        X_train, y_train = train_data_builder.build_input_data()
+        train_data_builder = InputCATSDatasetBuilder(qry_attn_tr, train_paras, train_queries,
+                                                     getattr(torch, vec_dtype))
+        train_data = train_data_builder.build_index_data()
         print('Building test data')
-        test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_pids, test_pvecs, test_qids, test_qvecs)
-        X_test, y_test = test_data_builder.build_input_data()
-
-        val_split_ratio = 0.1
-        val_sample_size = int(X_train.shape[0] * val_split_ratio)
-
-        X_val = X_train[:val_sample_size]
-        y_val = y_train[:val_sample_size]
-        X_train = X_train[val_sample_size:]
-        y_train = y_train[val_sample_size:]
-
-        if not os.path.isdir('cache'):
-            os.makedirs('cache')
-
-        np.save('cache/X_train.npy', X_train)
-        np.save('cache/y_train.npy', y_train)
-        np.save('cache/X_val.npy', X_val)
-        np.save('cache/y_val.npy', y_val)
-        np.save('cache/X_test.npy', X_test)
-        np.save('cache/y_test.npy', y_test)
-    else:
-        X_train = torch.tensor(np.load('cache/X_train.npy'))
-        y_train = torch.tensor(np.load('cache/y_train.npy'))
-        X_val = torch.tensor(np.load('cache/X_val.npy'))
-        y_val = torch.tensor(np.load('cache/y_val.npy'))
-        X_test = torch.tensor(np.load('cache/X_test.npy'))
-        y_test = torch.tensor(np.load('cache/y_test.npy'))
+        test_data_builder = InputCATSDatasetBuilder(qry_attn_ts, test_paras, test_queries,
+                                                    getattr(torch, vec_dtype))
+        test_data = test_data_builder.build_index_data()
+
+        val_sample_size = int(len(train_data) * val_split_ratio)
+
+        val_data = train_data.subset(slice(None, val_sample_size))
+        train_data = train_data.subset(slice(val_sample_size, None))
+
+        train_data.save(cache, 'train')
+        val_data.save(cache, 'val')
+        test_data.save(cache, 'test')
+    X_val, y_val = val_data[:]
+    X_test, y_test = test_data[:]
 
     if torch.cuda.is_available():
         device = torch.device('cuda:0')
@@ -146,7 +172,6 @@ def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pid
     euclid_auc = roc_auc_score(y_test, y_euclid)
     print('Test data Baseline euclidean auc: %.5f', euclid_auc)
 
-    train_samples = X_train.shape[0]
     #torch.cuda.empty_cache()
     '''
     X_train = X_train.cuda()
@@ -162,26 +187,40 @@ def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pid
     m = CATSSimilarityModel(768, cats_type).to(device)
     opt = optim.Adam(m.parameters(), lr=lrate)
     mseloss = nn.MSELoss()
+    train_loader = pair_loader(train_data, batch, num_workers)
+    train_metrics = StreamingMetrics()
+    # both loaders drop the last incomplete batch
+    num_batches = len(train_data) // batch
     print('Starting training...')
     for i in range(epochs):
         print('\nEpoch '+str(i+1))
-        for b in range(math.ceil(train_samples//batch)):
+        if stream:
+            train_data.set_epoch(i)
+        opt.zero_grad()
+        for b, (X_train_curr, y_train_curr) in enumerate(train_loader):
             m.train()
-            opt.zero_grad()
-            ypred = m(X_train[b*batch:b*batch + batch].to(device))
-            y_train_curr = y_train[b*batch:b*batch + batch].to(device)
+            ypred = m(X_train_curr.to(device, non_blocking=True))
+            y_train_curr = y_train_curr.to(device, non_blocking=True)
             loss = mseloss(ypred, y_train_curr)
-            auc = roc_auc_score(y_train_curr.detach().cpu().numpy(), ypred.detach().cpu().numpy())
-            loss.backward()
-            opt.step()
-            if b % 100 == 0:
+            # gradients of accum_steps batches are summed into one step of batch * accum_steps pairs, the last group of
+            # an epoch can be shorter and is stepped on its own, averaged over the batches it has
+            (loss / min(accum_steps, num_batches - b // accum_steps * accum_steps)).backward()
+            if (b + 1) % accum_steps == 0 or b + 1 == num_batches:
+                opt.step()
+                opt.zero_grad()
+            train_metrics.update(loss, ypred, y_train_curr)
+            if (b + 1) % log_interval == 0:
                 m.eval()
-                ypred_val = m(X_val)
-                val_loss = mseloss(ypred_val, y_val)
-                val_auc = roc_auc_score(y_val.detach().cpu().numpy(), ypred_val.detach().cpu().numpy())
+                with torch.no_grad():
+                    ypred_val = m(X_val)
+                    val_loss = mseloss(ypred_val, y_val)
+                    val_auc = roc_auc(y_val, ypred_val)
+                # train loss and auc over the batches since the last log
+                train_loss, train_auc = train_metrics.compute()
+                train_metrics.reset()
                 print(
                     '\rTrain loss: %.5f, Train auc: %.5f, Val loss: %.5f, Val auc: %.5f' %
-                    (loss.item(), auc, val_loss.item(), val_auc), end='')
+                    (train_loss, train_auc, val_loss.item(), val_auc.item()), end='')
     m.eval()
     m.cpu()
     ypred_test = m(X_test)
@@ -212,15 +251,27 @@ def main():
     parser.add_argument('-bt', '--batch', type=int, default=32)
     parser.add_argument('-ep', '--epochs', type=int, default=3)
     parser.add_argument('-ct', '--cats_type', default="cats")
-    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--cache', action='store_true', help='Reuse the datasets cached for the same input files')
     parser.add_argument('--save', action='store_true')
+    parser.add_argument('-vd', '--vec_dtype', choices=['float32', 'float16', 'bfloat16'], default='float32',
+                        help='dtype the para vecs are held in memory, they are upcast to float32 batch by batch')
+    parser.add_argument('-nw', '--num_workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('-li', '--log_interval', type=int, default=100, help='Batches between train/val metric logs')
+    parser.add_argument('-ac', '--accum_steps', type=int, default=1, help='Batches per optimizer step')
+    parser.add_argument('-th', '--threads', type=int, default=0, help='Intra-op CPU threads, 0 for the torch default')
+    parser.add_argument('-ith', '--interop_threads', type=int, default=0,
+                        help='Inter-op CPU threads, 0 for the torch default')
+    parser.add_argument('--stream', action='store_true', help='Read the train pairs from the vecs files while '
+                                                              'training instead of loading them in memory')
 
     args = parser.parse_args()
     dat = args.data_dir
 
     run_model(dat+args.qry_attn_train, dat+args.qry_attn_test, dat+args.train_pids, dat+args.test_pids, dat+args.train_pvecs,
               dat+args.test_pvecs, dat+args.train_qids, dat+args.test_qids, dat+args.train_qvecs, dat+args.test_qvecs,
-              args.cache, args.lrate, args.batch, args.epochs, args.save, args.cats_type)
+              args.cache, args.lrate, args.batch, args.epochs, args.save, args.cats_type, args.num_workers,
+              args.stream, args.log_interval, args.accum_steps, args.threads, args.interop_threads,
+              args.vec_dtype)
 
 
 if __name__ == '__main__':
@@ -1,19 +1,20 @@
 from model.layers import CATS_Attention, Sent_Attention, Sent_FixedCATS_Attention
-from data.utils import InputSentenceCATSDatasetBuilder
+from data.utils import InputSentenceCATSDatasetBuilder, SentencePairDataset, PackedSentencePairDataset, PairStream, \
+    pair_loader
+from data.embedding_store import EmbeddingStore
+from data.cache import FeatureCache
+from data.qry_attn import QryAttn
+from model.metrics import roc_auc, StreamingMetrics
 import torch
 torch.manual_seed(42)
 import torch.nn as nn
 import torch.optim as optim
-import numpy as np
 from numpy.random import seed
 seed(42)
-import tensorflow as tf
-import pickle
 from sklearn.metrics import roc_auc_score
 import argparse
-import math
 import time
-from model.models import CATSSimilarityModel
+from model.models import CATSSimilarityModel, set_threads
 
 class CATSSentenceModel(nn.Module):
     def __init__(self, emb_size, n, model_type, cats_path=None):
@@ -33,75 +34,85 @@ class CATSSentenceModel(nn.Module):
         self.pair_scores = self.cats(Xq, Xp)
         return self.pair_scores
 
+    def score_page(self, Xq, Xp):
+        '''
+        Scores all para pairs of a page from Xq, Xp as returned by InputSentenceCATSDatasetBuilder.build_page_data,
+        each para is attention pooled once
+        '''
+        return self.cats.score_page(Xq, Xp)
+
+    def forward_packed(self, Xq, sents, starts1, lengths1, starts2, lengths2):
+        self.pair_scores = self.cats.forward_packed(Xq, sents, starts1, lengths1, starts2, lengths2)
+        return self.pair_scores
+
 def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pids_file, train_pvecs_file,
               test_pvecs_file, train_qids_file, test_qids_file, train_qvecs_file, test_qvecs_file, use_cache,
-              n, max_seq, lrate, batch, epochs, save, model_type, cats_path):
-    if not use_cache:
-        qry_attn_tr = []
-        qry_attn_ts = []
-        with open(qry_attn_file_train, 'r') as trf:
-            f = True
-            for l in trf:
-                if f:
-                    f = False
-                    continue
-                qry_attn_tr.append(l.split('\t'))
-        with open(qry_attn_file_test, 'r') as tsf:
-            f = True
-            for l in tsf:
-                if f:
-                    f = False
-                    continue
-                qry_attn_ts.append(l.split('\t'))
-        train_pids = np.load(train_pids_file)
-        train_pvecs = np.load(train_pvecs_file)
-        train_qids = np.load(train_qids_file)
-        train_qvecs = np.load(train_qvecs_file)
+              n, max_seq, lrate, batch, epochs, save, model_type, cats_path, packed=False, num_workers=0,
+              stream=False, log_interval=100, accum_steps=1, threads=0, interop_threads=0,
+              vec_dtype='float32'):
+    set_threads(threads, interop_threads)
+    pair_dataset = PackedSentencePairDataset if packed else SentencePairDataset
+    val_split_ratio = 0.1
+    if not stream:
+        cache = FeatureCache('sent_cache', [qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pids_file,
+                                            train_pvecs_file, test_pvecs_file, train_qids_file, test_qids_file,
+                                            train_qvecs_file, test_qvecs_file], val_split_ratio, max_seq, packed, vec_dtype)
+    if stream:
+        # pairs stay row numbers into the memory mapped sentence vecs, batches are padded or packed while training
+        train_sents = EmbeddingStore(train_pids_file, train_pvecs_file)
+        test_sents = train_sents if train_pids_file == test_pids_file else EmbeddingStore(test_pids_file,
+                                                                                          test_pvecs_file)
+        train_data = PairStream.from_qry_attn(QryAttn.load(qry_attn_file_train),
+                                              EmbeddingStore(train_qids_file, train_qvecs_file), train_sents, batch,
+                                              max_seq_len=max_seq, packed=packed)
+        test_data = PairStream.from_qry_attn(QryAttn.load(qry_attn_file_test),
+                                             EmbeddingStore(test_qids_file, test_qvecs_file), test_sents, batch,
+                                             max_seq_len=max_seq, packed=packed)
+        val_sample_size = int(len(train_data) * val_split_ratio)
+        val_data = train_data.subset(slice(None, val_sample_size))
+        train_data = train_data.subset(slice(val_sample_size, None))
+    elif use_cache and 'test' in cache:
+        print('Loading data from ' + cache.path)
+        train_data = pair_dataset.load(cache, 'train')
+        val_data = pair_dataset.load(cache, 'val')
+        test_data = pair_dataset.load(cache, 'test')
+    else:
+        qry_attn_tr = QryAttn.load(qry_attn_file_train)
+        qry_attn_ts = QryAttn.load(qry_attn_file_test)
+        train_sents = EmbeddingStore(train_pids_file, train_pvecs_file)
+        train_queries = EmbeddingStore(train_qids_file, train_qvecs_file)
         if train_pids_file == test_pids_file:
-            test_pids = train_pids
-            test_pvecs = train_pvecs
+            test_sents = train_sents
         else:
-            test_pids = np.load(test_pids_file)
-            test_pvecs = np.load(test_pvecs_file)
-        test_qids = np.load(test_qids_file)
-        test_qvecs = np.load(test_qvecs_file)
+            test_sents = EmbeddingStore(test_pids_file, test_pvecs_file)
+        test_queries = EmbeddingStore(test_qids_file, test_qvecs_file)
 
         print('Building train data')
-        train_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_tr, train_pids, train_pvecs, train_qids, train_qvecs, max_seq)
-        X_train_q, X_train_p, y_train, _ = train_data_builder.build_input_data()
+        train_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_tr, train_sents, train_queries, max_seq,
+                                                             getattr(torch, vec_dtype))
+        if packed:
+            train_data = train_data_builder.build_packed_index_data()
+        else:
+            train_data = train_data_builder.build_index_data()
         print('Building test data')
-        test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_ts, test_pids, test_pvecs, test_qids, test_qvecs, max_seq)
-        X_test_q, X_test_p, y_test, _ = test_data_builder.build_input_data()
-
-        val_split_ratio = 0.1
-        val_sample_size = int(X_train_q.shape[0] * val_split_ratio)
-
-        X_val_q = X_train_q[:val_sample_size]
-        X_val_p = X_train_p[:val_sample_size]
-        y_val = y_train[:val_sample_size]
-        X_train_q = X_train_q[val_sample_size:]
-        X_train_p = X_train_p[val_sample_size:]
-        y_train = y_train[val_sample_size:]
-
-        np.save('sent_cache/X_train_q.npy', X_train_q)
-        np.save('sent_cache/X_train_p.npy', X_train_p)
-        np.save('sent_cache/y_train.npy', y_train)
-        np.save('sent_cache/X_val_q.npy', X_val_q)
-        np.save('sent_cache/X_val_p.npy', X_val_p)
-        np.save('sent_cache/y_val.npy', y_val)
-        np.save('sent_cache/X_test_q.npy', X_test_q)
-        np.save('sent_cache/X_test_p.npy', X_test_p)
-        np.save('sent_cache/y_test.npy', y_test)
-    else:
-        X_train_q = torch.tensor(np.load('sent_cache/X_train_q.npy'))
-        X_train_p = torch.tensor(np.load('sent_cache/X_train_p.npy'))
-        y_train = torch.tensor(np.load('sent_cache/y_train.npy'))
-        X_val_q = torch.tensor(np.load('sent_cache/X_val_q.npy'))
-        X_val_p = torch.tensor(np.load('sent_cache/X_val_p.npy'))
-        y_val = torch.tensor(np.load('sent_cache/y_val.npy'))
-        X_test_q = torch.tensor(np.load('sent_cache/X_test_q.npy'))
-        X_test_p = torch.tensor(np.load('sent_cache/X_test_p.npy'))
-        y_test = torch.tensor(np.load('sent_cache/y_test.npy'))
+        test_data_builder = InputSentenceCATSDatasetBuilder(qry_attn_ts, test_sents, test_queries, max_seq,
+                                                            getattr(torch, vec_dtype))
+        if packed:
+            test_data = test_data_builder.build_packed_index_data()
+        else:
+            test_data = test_data_builder.build_index_data()
+
+        val_sample_size = int(len(train_data) * val_split_ratio)
+
+        val_data = train_data.subset(slice(None, val_sample_size))
+        train_data = train_data.subset(slice(val_sample_size, None))
+
+        train_data.save(cache, 'train')
+        val_data.save(cache, 'val')
+        test_data.save(cache, 'test')
+    # X_val, X_test: (Xq, Xp) or, with packed, (Xq, sents, starts1, lengths1, starts2, lengths2)
+    *X_val, y_val = val_data[:]
+    *X_test, y_test = test_data[:]
 
     if torch.cuda.is_available():
         device = torch.device('cuda:0')
@@ -110,13 +121,11 @@ def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pid
         device = torch.device('cpu')
         # torch.cuda.set_device(torch.device('cpu'))
 
-    train_samples = X_train_q.shape[0]
     '''
     X_train = X_train.cuda()
     y_train = y_train.cuda()
     '''
-    X_val_q = X_val_q.to(device)
-    X_val_p = X_val_p.to(device)
+    X_val = [x.to(device) for x in X_val]
     y_val = y_val.to(device)
     '''
     X_test = X_test.cuda()
@@ -124,31 +133,46 @@ def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pid
     '''
 
     m = CATSSentenceModel(768, n, model_type, cats_path).to(device)
+    score = m.forward_packed if packed else m.forward
     opt = optim.Adam(m.parameters(), lr=lrate)
     mseloss = nn.MSELoss()
+    train_loader = pair_loader(train_data, batch, num_workers)
+    train_metrics = StreamingMetrics()
+    # both loaders drop the last incomplete batch
+    num_batches = len(train_data) // batch
     for i in range(epochs):
         print('\nEpoch ' + str(i + 1))
-        for b in range(math.ceil(train_samples // batch)):
+        if stream:
+            train_data.set_epoch(i)
+        opt.zero_grad()
+        for b, (*X_train_curr, y_train_curr) in enumerate(train_loader):
             m.train()
-            opt.zero_grad()
-            ypred = m(X_train_q[b * batch:b * batch + batch].to(device), X_train_p[b * batch:b * batch + batch].to(device))
-            y_train_curr = y_train[b * batch:b * batch + batch].to(device)
+            ypred = score(*[x.to(device, non_blocking=True) for x in X_train_curr])
+            y_train_curr = y_train_curr.to(device, non_blocking=True)
             loss = mseloss(ypred, y_train_curr)
-            auc = roc_auc_score(y_train_curr.detach().cpu().numpy(), ypred.detach().cpu().numpy())
-            loss.backward()
-            opt.step()
-            if b % 100 == 0:
+            # gradients of accum_steps batches are summed into one step of batch * accum_steps pairs, the last group of
+            # an epoch can be shorter and is stepped on its own, averaged over the batches it has
+            (loss / min(accum_steps, num_batches - b // accum_steps * accum_steps)).backward()
+            if (b + 1) % accum_steps == 0 or b + 1 == num_batches:
+                opt.step()
+                opt.zero_grad()
+            train_metrics.update(loss, ypred, y_train_curr)
+            if (b + 1) % log_interval == 0:
                 m.eval()
-                ypred_val = m(X_val_q, X_val_p)
-                val_loss = mseloss(ypred_val, y_val)
-                val_auc = roc_auc_score(y_val.detach().cpu().numpy(), ypred_val.detach().cpu().numpy())
+                with torch.no_grad():
+                    ypred_val = score(*X_val)
+                    val_loss = mseloss(ypred_val, y_val)
+                    val_auc = roc_auc(y_val, ypred_val)
+                # train loss and auc over the batches since the last log
+                train_loss, train_auc = train_metrics.compute()
+                train_metrics.reset()
                 print(
                     '\rTrain loss: %.5f, Train auc: %.5f, Val loss: %.5f, Val auc: %.5f' %
-                    (loss.item(), auc, val_loss.item(), val_auc), end='')
+                    (train_loss, train_auc, val_loss.item(), val_auc.item()), end='')
         m.eval()
         if torch.cuda.is_available():
             m.cpu()
-        ypred_test = m(X_test_q, X_test_p)
+        ypred_test = score(*X_test)
         test_loss = mseloss(ypred_test, y_test)
         test_auc = roc_auc_score(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
         print('\n\nTest loss: %.5f, Test auc: %.5f' % (test_loss.item(), test_auc))
@@ -156,7 +180,7 @@ def run_model(qry_attn_file_train, qry_attn_file_test, train_pids_file, test_pid
             m.cuda()
     m.eval()
     m.cpu()
-    ypred_test = m(X_test_q, X_test_p)
+    ypred_test = score(*X_test)
     test_loss = mseloss(ypred_test, y_test)
     test_auc = roc_auc_score(y_test.detach().cpu().numpy(), ypred_test.detach().cpu().numpy())
     print('\n\nTest loss: %.5f, Test auc: %.5f' % (test_loss.item(), test_auc))
@@ -177,22 +201,36 @@ def main():
     parser.add_argument('-tq', '--test_qids', default="by1train-context-title-qids.npy")
     parser.add_argument('-trqv', '--train_qvecs', default="half-y1train-qry-attn-context-title-qvecs.npy")
     parser.add_argument('-tqv', '--test_qvecs', default="by1train-context-title-qvecs.npy")
-    parser.add_argument('-seq', '--max_seq', default=10)
+    parser.add_argument('-seq', '--max_seq', type=int, default=10)
     parser.add_argument('-np', '--param_n', type=int, default=32)
     parser.add_argument('-lr', '--lrate', type=float, default=0.0001)
     parser.add_argument('-bt', '--batch', type=int, default=32)
     parser.add_argument('-ep', '--epochs', type=int, default=6)
     parser.add_argument('-mt', '--model_type', default="fcats")
     parser.add_argument('-cp', '--cats_path', default='/home/sk1105/sumanta/cats_deploy/model/saved_models/cats_title_b32_l0.00001_i3.model')
-    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--cache', action='store_true', help='Reuse the datasets cached for the same input files')
     parser.add_argument('--save', action='store_true')
+    parser.add_argument('-vd', '--vec_dtype', choices=['float32', 'float16', 'bfloat16'], default='float32',
+                        help='dtype the para vecs are held in memory, they are upcast to float32 batch by batch')
+    parser.add_argument('--packed', action='store_true', help='Feed the para sentences packed instead of padded')
+    parser.add_argument('-nw', '--num_workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('-li', '--log_interval', type=int, default=100, help='Batches between train/val metric logs')
+    parser.add_argument('-ac', '--accum_steps', type=int, default=1, help='Batches per optimizer step')
+    parser.add_argument('-th', '--threads', type=int, default=0, help='Intra-op CPU threads, 0 for the torch default')
+    parser.add_argument('-ith', '--interop_threads', type=int, default=0,
+                        help='Inter-op CPU threads, 0 for the torch default')
+    parser.add_argument('--stream', action='store_true', help='Read the train pairs from the vecs files while '
+                                                              'training instead of loading them in memory')
 
     args = parser.parse_args()
     dat = args.data_dir
 
     run_model(dat+args.qry_attn_train, dat+args.qry_attn_test, dat+args.train_pids, dat+args.test_pids, dat+args.train_pvecs,
               dat+args.test_pvecs, dat+args.train_qids, dat+args.test_qids, dat+args.train_qvecs, dat+args.test_qvecs,
-              args.cache, args.param_n, args.max_seq, args.lrate, args.batch, args.epochs, args.save, args.model_type, args.cats_path)
+              args.cache, args.param_n, args.max_seq, args.lrate, args.batch, args.epochs, args.save, args.model_type, args.cats_path,
+              args.packed, args.num_workers, args.stream,
+              args.log_interval, args.accum_steps, args.threads, args.interop_threads,
+              args.vec_dtype)
 
 
 if __name__ == '__main__':
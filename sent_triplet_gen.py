@@ -6,19 +6,11 @@ random.seed(42)
 import csv
 import os
 import argparse
+from data.qrels import Qrels
 
 def read_art_qrels(art_qrels):
-    art_qrels_dict = {}
-    with open(art_qrels, 'r') as art:
-        qrels_lines = art.readlines()
-    for l in qrels_lines:
-        title = l.split(' ')[0]
-        if '/' in title:
-            continue
-        art_qrels_dict[title] = set()
-    for l in qrels_lines:
-        para = l.split(' ')[2]
-        art_qrels_dict[title].add(para)
+    qrels = Qrels(art_qrels)
+    art_qrels_dict = {title: set(qrels.paras(title)) for title in qrels if '/' not in title}
     print('art qrels read')
     titles = list(art_qrels_dict.keys())
     random.shuffle(titles)
@@ -40,22 +32,10 @@ def sent_triple_gen(art_qrels, top_qrels, train_paratext, outdir):
             else:
                 paratext_dict[l.split('\t')[0]] = l.split('\t')[1]
     print('Paratext read')
+    qrels = Qrels(top_qrels)
     top_qrels_dict = {}
-    with open(top_qrels, 'r') as tq:
-        tq_lines = tq.readlines()
-    print('top qrels lines read')
-    for l in tq_lines:
-        q = l.split(' ')[0]
-        title = q.split('/')[0]
-        top_qrels_dict[title] = {}
-    print('top qrels phase 1')
-    for l in tq_lines:
-        q = l.split(' ')[0]
-        p = l.split(' ')[2]
-        if q not in top_qrels_dict[title].keys():
-            top_qrels_dict[title][q] = set([p])
-        else:
-            top_qrels_dict[title][q].add(p)
+    for q in qrels:
+        top_qrels_dict.setdefault(q.split('/')[0], {})[q] = set(qrels.paras(q))
     print('Top qrels read')
     triples = []
     i = 0